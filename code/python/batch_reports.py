@@ -0,0 +1,125 @@
+# --- Header -------------------------------------------------------------------
+# Batch generation of the market shares and figures for many (report year, country subset,
+# network taxonomy) jobs over a pool of worker processes
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from utils import (
+    read_config, setup_logging, set_verbosity, data_path, read_data, write_mapped_data, read_mapped_data,
+    fill_missing, instrument
+)
+from prepare_data import standardize_auditor_network_names, map_auditor_networks
+from do_analysis import sum_audit_counts, market_shares_from_counts, save_market_shares, plot_market_shares
+
+log = setup_logging()
+
+# Audit counts by country, report year, audit firm and network, shared by all jobs
+SHARED_KEYS = ['trans_report_auditor_state', 'report_year', 'auditor_fkey', 'auditor_network']
+
+# Path of the shared audit counts and the settings of a worker process, set once by the pool initializer
+_worker_settings = None
+
+def main():
+    '''
+    Runs all batch jobs of the config and saves a summary of the generated outputs.
+    '''
+    log.info("Generating batch reports ...")
+    cfg = read_config('config/batch_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+    prepare_cfg = read_config('config/prepare_data_cfg.yaml')
+    set_verbosity(cfg.get('verbosity', 'INFO'))
+
+    # Aggregate the prepared data once into a memory-mapped file that all workers read from
+    prepared_data_path = data_path(analysis_cfg['prepared_data_save_path'], analysis_cfg['storage_format'])
+    build_shared_counts(prepared_data_path, cfg['shared_data_path'])
+
+    taxonomies = {'default': prepare_cfg['network_taxonomy'], **(cfg.get('taxonomies') or {})}
+    paths = {key: cfg[key] for key in ['aggregated_data_save_path', 'figure_save_path', 'plot_data_save_path']}
+    summary = run_jobs(
+        cfg['jobs'], cfg['shared_data_path'], taxonomies, paths, analysis_cfg['countries_order'], cfg.get('workers')
+    )
+    save_market_shares(summary, cfg['summary_save_path'])
+    log.info("Generating batch reports ... Done!")
+
+@instrument
+def build_shared_counts(prepared_data_path, shared_path):
+    '''
+    Sums the audit weights of the prepared data by country, report year, audit firm and network,
+    and writes them as an uncompressed Arrow IPC file that the workers memory-map.
+    '''
+    df = read_data(prepared_data_path, columns=SHARED_KEYS + ['audit_weight'])
+    counts = (
+        df.groupby(SHARED_KEYS, dropna=False, observed=True, sort=False)['audit_weight']
+        .sum()
+        .reset_index(name='audit_count')
+    )
+    write_mapped_data(counts, shared_path)
+    log.info(f"Shared audit counts ({len(counts)} rows) saved to {shared_path}.")
+
+def job_paths(job, paths):
+    '''
+    Fills the output path templates with the fields of a job (e.g. {name} and {report_year}).
+    '''
+    return {key: template.format(**job) for key, template in paths.items()}
+
+def run_job(job):
+    '''
+    Calculates and saves the market shares and the figure of one job in a worker process.
+    Only the rows of the job's report year and countries are read from the shared audit counts.
+    '''
+    shared_path, taxonomies, paths, countries_order = _worker_settings
+    start = time.perf_counter()
+    filters = {'report_year': [job['report_year']]}
+    if job.get('countries'):
+        filters['trans_report_auditor_state'] = job['countries']
+    counts = read_mapped_data(shared_path, filters=filters)
+
+    # Group the networks with the job's taxonomy
+    taxonomy = taxonomies[job.get('taxonomy', 'default')]
+    counts['auditor_network'] = fill_missing(counts['auditor_network'], taxonomy['blank_group'])
+    counts = standardize_auditor_network_names(counts, taxonomy['aliases'])
+    counts = map_auditor_networks(counts, taxonomy)
+
+    market_shares = market_shares_from_counts(sum_audit_counts(counts))
+    output_paths = job_paths(job, paths)
+    save_market_shares(market_shares, output_paths['aggregated_data_save_path'])
+    plot_market_shares(
+        market_shares, output_paths['figure_save_path'], output_paths['plot_data_save_path'], countries_order
+    )
+    return {'name': job['name'], 'rows': len(counts), 'seconds': round(time.perf_counter() - start, 3), **output_paths}
+
+def init_worker(shared_path, taxonomies, paths, countries_order):
+    '''
+    Keeps the job settings in the worker process for all its tasks, with the logging of the
+    analysis steps reduced to warnings.
+    '''
+    global _worker_settings
+    _worker_settings = (shared_path, taxonomies, paths, countries_order)
+    set_verbosity('WARNING')
+
+@instrument
+def run_jobs(jobs, shared_path, taxonomies, paths, countries_order, workers=None):
+    '''
+    Runs the jobs over a pool of `workers` processes and returns one summary row per job.
+    '''
+    names = [job['name'] for job in jobs]
+    if len(set(names)) < len(names):
+        raise ValueError("Batch job names must be unique, they are used in the output paths.")
+    unknown = {job['taxonomy'] for job in jobs if 'taxonomy' in job} - set(taxonomies)
+    if unknown:
+        raise ValueError(f"Unknown taxonomies in batch jobs: {sorted(unknown)}")
+
+    log.info(f"Running {len(jobs)} batch jobs ...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(shared_path, taxonomies, paths, countries_order)) as executor:
+        summary = pd.DataFrame(list(executor.map(run_job, jobs)))
+    for row in summary.itertuples():
+        log.info(f"Batch job {row.name}: {row.rows} audit count rows in {row.seconds:.2f}s")
+    return summary
+
+if __name__ == '__main__':
+    main()
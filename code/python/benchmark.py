@@ -0,0 +1,175 @@
+# --- Header -------------------------------------------------------------------
+# Benchmark the preparation and analysis steps on synthetic transparency report data
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import os
+import io
+import gc
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from utils import read_config, setup_logging, read_data, write_data
+from synthetic_data import generate_transparency_reports
+from prepare_data import (
+    prepare_transparency_data, standardize_greece_abbreviation, validate_transparency_data,
+    standardize_auditor_network_names, map_auditor_networks, assign_joint_audit_weights
+)
+from do_analysis import (
+    calculate_market_shares, build_audit_counts, calculate_big4_market_share, calculate_kap10_market_share,
+    calculate_cr4_market_share, calculate_eu_level_market_shares, plot_market_shares
+)
+
+log = setup_logging()
+
+def main():
+    '''
+    Runs the benchmark suite for every scale in the config and saves the results as JSON.
+    '''
+    cfg = read_config('config/benchmark_cfg.yaml')
+    taxonomy = read_config('config/prepare_data_cfg.yaml')['network_taxonomy']
+
+    results = []
+    for n_rows in cfg['scales']:
+        log.info(f"Benchmarking with {n_rows} synthetic rows ...")
+        pulled = generate_transparency_reports(n_rows, **cfg['synthetic_data'])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name, func, make_args in benchmark_steps(pulled, taxonomy, tmp_dir):
+                seconds, peak_memory = time_step(func, make_args, cfg['repeats'])
+                results.append({
+                    'rows': n_rows, 'step': name,
+                    'seconds': round(seconds, 6), 'peak_memory_mb': round(peak_memory / 1024 ** 2, 3)
+                })
+                log.info(f"{name} ({n_rows} rows): {seconds:.3f}s, peak memory {peak_memory / 1024 ** 2:.1f} MB")
+
+    save_path = save_results(results, cfg)
+    if cfg.get('compare_with'):
+        compare_results(
+            cfg['compare_with'], save_path, cfg.get('regression_threshold', 1.2), cfg.get('regression_min_seconds', 0.05)
+        )
+
+def benchmark_steps(pulled, taxonomy, tmp_dir):
+    '''
+    Returns (name, function, argument factory) for every benchmarked step. The argument
+    factories return fresh copies, because several steps modify their input.
+    '''
+    prepared = assign_joint_audit_weights(prepare_transparency_data(pulled.copy(), taxonomy), 'split')
+    counts = build_audit_counts(prepared)
+    big4_shares = calculate_big4_market_share(counts)
+    market_shares = calculate_market_shares(prepared)
+    csv_path = os.path.join(tmp_dir, 'prepared.csv')
+    parquet_path = os.path.join(tmp_dir, 'prepared.parquet')
+
+    return [
+        ('standardize_greece_abbreviation', standardize_greece_abbreviation, lambda: (pulled.copy(),)),
+        ('validate_transparency_data', validate_transparency_data, lambda: (pulled.copy(), taxonomy)),
+        ('standardize_auditor_network_names', standardize_auditor_network_names,
+         lambda: (prepared.copy(), taxonomy['aliases'])),
+        ('map_auditor_networks', map_auditor_networks, lambda: (prepared.copy(), taxonomy)),
+        ('assign_joint_audit_weights', assign_joint_audit_weights, lambda: (prepared.copy(), 'split')),
+        ('prepare_transparency_data', prepare_transparency_data, lambda: (pulled.copy(), taxonomy)),
+        ('write_data_csv', write_data, lambda: (prepared, csv_path)),
+        ('read_data_csv', read_data, lambda: (csv_path,)),
+        ('write_data_parquet', write_data, lambda: (prepared, parquet_path)),
+        ('read_data_parquet', read_data, lambda: (parquet_path,)),
+        ('build_audit_counts', build_audit_counts, lambda: (prepared,)),
+        ('calculate_big4_market_share', calculate_big4_market_share, lambda: (counts,)),
+        ('calculate_kap10_market_share', calculate_kap10_market_share, lambda: (counts,)),
+        ('calculate_cr4_market_share', calculate_cr4_market_share, lambda: (counts, big4_shares)),
+        ('calculate_eu_level_market_shares', calculate_eu_level_market_shares, lambda: (counts,)),
+        ('calculate_market_shares', calculate_market_shares, lambda: (prepared,)),
+        ('plot_market_shares', plot_market_shares, lambda: (
+            market_shares.copy(), os.path.join(tmp_dir, 'figure.png'), os.path.join(tmp_dir, 'figure_data.csv'),
+            read_config('config/do_analysis_cfg.yaml')['countries_order']
+        )),
+    ]
+
+def time_step(func, make_args, repeats):
+    '''
+    Runs a step `repeats` times and returns the fastest wall time (seconds) and the peak memory
+    allocated during the step (bytes). The peak is traced by tracemalloc in one more, untimed run,
+    since tracing slows the step down. numpy and pandas report their buffers to tracemalloc,
+    Arrow's memory pool does not, so the parquet steps only show the memory of their pandas side.
+    '''
+    best_seconds = float('inf')
+    for _ in range(repeats):
+        args = make_args()
+        gc.collect()
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            func(*args)
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+
+    args = make_args()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with redirect_stdout(io.StringIO()):
+            func(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best_seconds, peak_memory
+
+def git_commit():
+    '''
+    Returns the current git commit hash, or None outside a git repository.
+    '''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(results, cfg):
+    '''
+    Saves the benchmark results together with the code and library versions as JSON.
+    '''
+    os.makedirs(cfg['results_dir'], exist_ok=True)
+    created = datetime.now()
+    save_path = os.path.join(cfg['results_dir'], f"benchmark_{created:%Y%m%d_%H%M%S}.json")
+    with open(save_path, 'w') as f:
+        json.dump({
+            'created': created.isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'synthetic_data': cfg['synthetic_data'],
+            'repeats': cfg['repeats'],
+            'results': results,
+        }, f, indent=2)
+    log.info(f"Benchmark results saved to {save_path}.")
+    return save_path
+
+def compare_results(baseline_path, results_path, threshold, min_seconds=0.05):
+    '''
+    Compares two benchmark result files and logs every step that got slower by more than `threshold` times
+    (ignoring differences below `min_seconds`, which are mostly timing noise).
+    '''
+    with open(baseline_path, 'r') as f:
+        baseline = pd.DataFrame(json.load(f)['results'])
+    with open(results_path, 'r') as f:
+        current = pd.DataFrame(json.load(f)['results'])
+    comparison = current.merge(baseline, on=['rows', 'step'], suffixes=('', '_baseline'))
+    comparison['slowdown'] = comparison['seconds'] / comparison['seconds_baseline']
+    regressions = comparison[
+        (comparison['slowdown'] > threshold) & (comparison['seconds'] - comparison['seconds_baseline'] > min_seconds)
+    ]
+    for row in regressions.itertuples():
+        log.warning(f"Regression in {row.step} ({row.rows} rows): {row.seconds_baseline:.3f}s -> {row.seconds:.3f}s")
+    if regressions.empty:
+        log.info(f"No step is more than {threshold}x slower than in {baseline_path}.")
+    return comparison
+
+if __name__ == '__main__':
+    main()
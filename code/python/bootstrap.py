@@ -0,0 +1,136 @@
+# --- Header -------------------------------------------------------------------
+# Bootstrap confidence intervals for the Big 4, 10KAP and CR4 market shares
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from utils import setup_logging, instrument
+
+log = setup_logging()
+
+# Resampling units and the column of the prepared data that identifies them
+BOOTSTRAP_UNITS = {'entity': 'entity_map_fkey', 'report': 'transparency_report_fkey'}
+BOOTSTRAP_METRICS = ['big4_market_share', 'kap10_market_share', 'cr4_market_share']
+
+# Strata of a worker process, set once by the pool initializer instead of being sent with every task
+_worker_strata = None
+
+def encode_strata(counts, unit_column):
+    '''
+    Integer-encodes the audit count table by country, resampling unit, audit firm and network group
+    into one stratum per country. A stratum holds one entry per (unit, firm, network group) with its
+    audit count, sorted by firm, so that firm totals can be summed with np.add.reduceat.
+    '''
+    counts = counts[counts['audit_count'] > 0]
+    counts = counts.assign(firm_code=pd.factorize(counts['auditor_fkey'])[0])
+    n_firms = counts['firm_code'].max() + 1
+
+    strata = []
+    for country, group in counts.groupby('trans_report_auditor_state', observed=True, sort=True):
+        group = group.sort_values('firm_code', kind='stable')
+        firms = group['firm_code'].to_numpy()
+        network_groups = group['network_group'].to_numpy()
+        firm_starts = np.flatnonzero(np.r_[True, firms[1:] != firms[:-1]])
+        # Audits of firms without auditor_fkey count in the totals, but not as a firm in the CR4
+        known_firms = firms[firm_starts] >= 0
+        strata.append({
+            'country': country,
+            'n_units': group[unit_column].nunique(),
+            'entry_unit': pd.factorize(group[unit_column])[0],
+            'entry_count': group['audit_count'].to_numpy('float64'),
+            'big4': network_groups == 'Big 4',
+            'kap10': np.isin(network_groups, ['10KAP', 'Big 4']),
+            'firm_starts': firm_starts,
+            'known_firms': known_firms,
+            'firm_codes': firms[firm_starts][known_firms],
+        })
+    return strata, n_firms
+
+def top4_sum(firm_counts):
+    '''
+    Returns the summed audit counts of the four largest firms for every replicate (row).
+    '''
+    if firm_counts.shape[1] <= 4:
+        return firm_counts.sum(axis=1)
+    return np.partition(firm_counts, -4, axis=1)[:, -4:].sum(axis=1)
+
+def replicate_shares(strata, n_firms, weights):
+    '''
+    Calculates the Big 4, 10KAP and CR4 market shares per country and for the EU from the
+    unit weights of every stratum (replicates x units, the number of draws of every unit).
+    Returns an array of shape (metric, replicate, country), with the EU as the last country.
+    '''
+    n_replicates = weights[0].shape[0]
+    shares = np.empty((len(BOOTSTRAP_METRICS), n_replicates, len(strata) + 1))
+    eu_totals = np.zeros((3, n_replicates))
+    eu_firm_counts = np.zeros((n_replicates, n_firms))
+    for i, (stratum, unit_weights) in enumerate(zip(strata, weights)):
+        audits = unit_weights[:, stratum['entry_unit']] * stratum['entry_count']
+        totals = np.stack([
+            audits.sum(axis=1), audits[:, stratum['big4']].sum(axis=1), audits[:, stratum['kap10']].sum(axis=1)
+        ])
+        firm_counts = np.add.reduceat(audits, stratum['firm_starts'], axis=1)[:, stratum['known_firms']]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shares[:, :, i] = np.stack([totals[1], totals[2], top4_sum(firm_counts)]) / totals[0] * 100
+        eu_totals += totals
+        eu_firm_counts[:, stratum['firm_codes']] += firm_counts
+    shares[:, :, -1] = np.stack([eu_totals[1], eu_totals[2], top4_sum(eu_firm_counts)]) / eu_totals[0] * 100
+    return shares
+
+def init_worker(strata, n_firms):
+    '''
+    Keeps the strata in the worker process for all its tasks.
+    '''
+    global _worker_strata
+    _worker_strata = (strata, n_firms)
+
+def run_replicates(n_replicates, seed):
+    '''
+    Draws `n_replicates` bootstrap samples in a worker process. Every stratum is resampled on its own,
+    with as many units drawn with replacement as it has, counted into unit weights with np.bincount.
+    '''
+    strata, n_firms = _worker_strata
+    rng = np.random.default_rng(seed)
+    offsets = np.arange(n_replicates)[:, None]
+    weights = []
+    for stratum in strata:
+        n_units = stratum['n_units']
+        draws = rng.integers(0, n_units, size=(n_replicates, n_units)) + offsets * n_units
+        weights.append(np.bincount(draws.ravel(), minlength=n_replicates * n_units).reshape(n_replicates, n_units))
+    return replicate_shares(strata, n_firms, weights)
+
+@instrument
+def bootstrap_market_shares(counts, market_shares, unit, replicates, confidence_level=0.95,
+                            batch_size=100, workers=None, seed=0):
+    '''
+    Bootstraps the Big 4, 10KAP and CR4 market shares per country and for the EU by resampling entities
+    or transparency reports (`unit`) with replacement within each country. `counts` is the audit count
+    table by country, unit, audit firm and network group. The replicates are drawn in batches of
+    `batch_size` over a pool of `workers` processes, and every batch has its own seed, so the intervals
+    do not depend on the number of workers.
+
+    Returns the point estimates of `market_shares` with the percentile confidence intervals.
+    '''
+    strata, n_firms = encode_strata(counts, BOOTSTRAP_UNITS[unit])
+    batches = [min(batch_size, replicates - start) for start in range(0, replicates, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+    log.info(f"Bootstrapping market shares with {replicates} replicates of {unit} samples ...")
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=init_worker,
+                             initargs=(strata, n_firms)) as executor:
+        shares = np.concatenate(list(executor.map(run_replicates, batches, seeds)), axis=1)
+
+    alpha = (1 - confidence_level) / 2
+    lower, upper = np.nanquantile(shares, [alpha, 1 - alpha], axis=1)
+    intervals = pd.DataFrame({'trans_report_auditor_state': [stratum['country'] for stratum in strata] + ['EU']})
+    for i, metric in enumerate(BOOTSTRAP_METRICS):
+        intervals[f'{metric}_ci_lower'] = lower[i]
+        intervals[f'{metric}_ci_upper'] = upper[i]
+
+    estimates = market_shares[['trans_report_auditor_state'] + BOOTSTRAP_METRICS].astype(
+        {'trans_report_auditor_state': object}
+    )
+    return estimates.merge(intervals, on='trans_report_auditor_state', how='left')
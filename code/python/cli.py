@@ -0,0 +1,50 @@
+# --- Header -------------------------------------------------------------------
+# Command line entry point for all steps and tools of the project. It only imports the module
+# of the command being run, so `--help` and the connection check start without pandas or wrds.
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import sys
+import argparse
+import importlib
+
+# Commands: module and function they run, and their help text
+COMMANDS = {
+    'pull': ('pull_wrds_data', 'main', "Pull the transparency report data from WRDS"),
+    'prepare': ('prepare_data', 'main', "Prepare the pulled data"),
+    'analyse': ('do_analysis', 'main', "Calculate the market shares and plot them"),
+    'pipeline': ('run_pipeline', 'main', "Run pull, prepare and analysis in one process"),
+    'batch': ('batch_reports', 'main', "Run the analysis jobs of config/batch_cfg.yaml"),
+    'serve': ('query_service', 'main', "Serve market share queries over HTTP"),
+    'sweep': ('sweep_assumptions', 'main', "Recalculate the shares for every assumption combination"),
+    'benchmark': ('benchmark', 'main', "Time the steps on synthetic data"),
+    'startup-benchmark': ('startup_benchmark', 'main', "Time the cold start of the commands against the budget"),
+}
+
+def build_parser():
+    '''
+    Builds the argument parser. Only the connection check has options, added by test_wrds_connection.py,
+    which imports nothing heavy.
+    '''
+    from test_wrds_connection import add_arguments
+
+    parser = argparse.ArgumentParser(description="Audit market concentration in the EU (run from the repository root).")
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+    for name, (_, _, help_text) in COMMANDS.items():
+        commands.add_parser(name, help=help_text, description=help_text)
+    check = commands.add_parser(
+        'check-connection', help="Check the connection to WRDS", description="Check the connection to WRDS"
+    )
+    add_arguments(check)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'check-connection':
+        from test_wrds_connection import check_connection
+        return check_connection(args.mode, args.timeout)
+    module, function, _ = COMMANDS[args.command]
+    return getattr(importlib.import_module(module), function)()
+
+if __name__ == '__main__':
+    sys.exit(main())
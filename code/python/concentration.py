@@ -0,0 +1,136 @@
+# --- Header -------------------------------------------------------------------
+# Auditor ranking by country and the EU, and the concentration measures answered from it
+# (CRk for any k, top-N audit firms, Lorenz curves and Gini coefficients)
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+from utils import setup_logging, instrument
+
+log = setup_logging()
+
+# Columns of the auditor ranking, saved next to the aggregated market shares
+RANKING_COLUMNS = [
+    'trans_report_auditor_state', 'auditor_fkey', 'audit_count', 'market_share', 'rank', 'cumulative_share'
+]
+
+@instrument
+def build_auditor_ranking(counts):
+    '''
+    Ranks the audit firms of every country and of the EU by their audit count, from the audit count table
+    by country, firm and network group. Market shares and cumulative shares are in % of all audits of the
+    country, so the cumulative share at rank k is the CRk. Firms with equal counts are ranked by auditor_fkey.
+    Audits of firms without auditor_fkey count in the totals, but are not ranked (as in the CR4).
+    '''
+    firm_totals = counts.groupby(['trans_report_auditor_state', 'auditor_fkey'], observed=True)['audit_count'] \
+        .sum().reset_index()
+    firm_totals['trans_report_auditor_state'] = firm_totals['trans_report_auditor_state'].astype(object)
+    countries = counts['trans_report_auditor_state'].astype(object)
+    country_totals = counts.groupby(countries)['audit_count'].sum()
+
+    # The EU ranks the firms by their audits over all countries, as calculate_eu_level_market_shares
+    eu_totals = firm_totals.groupby('auditor_fkey')['audit_count'].sum().reset_index()
+    eu_totals.insert(0, 'trans_report_auditor_state', 'EU')
+    country_totals['EU'] = counts['audit_count'].sum()
+
+    ranking = pd.concat([
+        firm_totals.sort_values('trans_report_auditor_state', kind='stable'), eu_totals
+    ], ignore_index=True)
+    country_order = {country: position for position, country in enumerate(ranking['trans_report_auditor_state'].unique())}
+    ranking = ranking.assign(country_order=ranking['trans_report_auditor_state'].map(country_order)) \
+        .sort_values(['country_order', 'audit_count', 'auditor_fkey'], ascending=[True, False, True]) \
+        .drop(columns='country_order').reset_index(drop=True)
+
+    totals = ranking['trans_report_auditor_state'].map(country_totals)
+    ranking['market_share'] = ranking['audit_count'] / totals * 100
+    ranking['rank'] = ranking.groupby('trans_report_auditor_state', sort=False).cumcount() + 1
+    ranking['cumulative_share'] = ranking.groupby('trans_report_auditor_state', sort=False)['audit_count'].cumsum() \
+        / totals * 100
+    return ranking[RANKING_COLUMNS]
+
+class AuditorRanking:
+    '''
+    Concentration queries on the auditor ranking, without regrouping the audit data. The ranking is sorted
+    by country and rank, so the firms of a country are one block of rows, located by its row offsets.
+
+    Countries (optional, a single country or a list) default to all countries of the ranking, including the EU.
+    '''
+
+    def __init__(self, ranking):
+        self.ranking = ranking.reset_index(drop=True)
+        countries = self.ranking['trans_report_auditor_state'].to_numpy()
+        starts = np.flatnonzero(np.r_[True, countries[1:] != countries[:-1]]) if len(countries) else np.empty(0, int)
+        ends = np.r_[starts[1:], len(countries)]
+        self.blocks = {country: (start, end) for country, start, end in zip(countries[starts], starts, ends)}
+
+    @classmethod
+    def from_csv(cls, path):
+        '''
+        Loads the auditor ranking saved by the analysis.
+        '''
+        ranking = pd.read_csv(
+            path, dtype={'trans_report_auditor_state': str, 'auditor_fkey': 'Int32'},
+            keep_default_na=False, na_values=[''], float_precision='round_trip'
+        )
+        return cls(ranking)
+
+    def countries(self):
+        return list(self.blocks)
+
+    def concentration_ratio(self, k, countries=None):
+        '''
+        CRk: market share in % of the k largest audit firms by country. Countries with fewer than k firms
+        have the share of all their firms.
+        '''
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}.")
+        countries = self._countries(countries)
+        cumulative_share = self.ranking['cumulative_share'].to_numpy()
+        return pd.DataFrame({
+            'trans_report_auditor_state': countries,
+            f'cr{k}_market_share': [cumulative_share[min(self.blocks[c][0] + k, self.blocks[c][1]) - 1] for c in countries],
+        })
+
+    def top(self, n=10, countries=None):
+        '''
+        The n largest audit firms by country with their audit count, market share and cumulative share.
+        '''
+        countries = self._countries(countries)
+        positions = np.concatenate([np.arange(start, min(start + n, end)) for start, end in map(self.blocks.get, countries)])
+        return self.ranking.take(positions).reset_index(drop=True)
+
+    def lorenz_curve(self, country):
+        '''
+        Lorenz curve of the audit counts of a country: cumulative share of the firms (from the smallest)
+        against their cumulative share of the audits, both in % and starting at (0, 0).
+        '''
+        start, end = self.blocks[self._countries(country)[0]]
+        audit_counts = self.ranking['audit_count'].to_numpy()[start:end][::-1]
+        firms = np.arange(len(audit_counts) + 1)
+        return pd.DataFrame({
+            'trans_report_auditor_state': country,
+            'cumulative_firm_share': firms / len(audit_counts) * 100,
+            'cumulative_audit_share': np.r_[0, np.cumsum(audit_counts)] / audit_counts.sum() * 100,
+        })
+
+    def gini(self, countries=None):
+        '''
+        Gini coefficient of the audit counts of the ranked firms by country, from 0 (all firms audit equally
+        many entities) to 1 - 1/n (one of the n firms audits all entities).
+        '''
+        countries = self._countries(countries)
+        gini = []
+        for country in countries:
+            curve = self.lorenz_curve(country)['cumulative_audit_share'].to_numpy() / 100
+            gini.append(1 - (curve[1:] + curve[:-1]).sum() / (len(curve) - 1))
+        return pd.DataFrame({'trans_report_auditor_state': countries, 'gini': gini})
+
+    def _countries(self, countries):
+        if countries is None:
+            return list(self.blocks)
+        countries = [countries] if isinstance(countries, str) else list(countries)
+        unknown = [country for country in countries if country not in self.blocks]
+        if unknown:
+            raise LookupError(f"No ranked audit firms for {unknown}.")
+        return countries
@@ -1,183 +1,351 @@
 # We start by loading the libraries that we will use in this analysis.
 import os
-import pickle
 import pandas as pd
-import matplotlib.pyplot as plt
-from utils import read_config, setup_logging
+import utils
+import schema
+from utils import (
+    read_config, setup_logging, set_verbosity, log_frame, data_path, read_data, write_data, iter_data, read_mapped_data,
+    apply_dtypes, instrument, track_step, write_metrics
+)
+from stage_cache import stage_key, restore_outputs, store_outputs
+from schema import validate_schema
+import bootstrap
+import figures
+import concentration
+from bootstrap import BOOTSTRAP_UNITS, bootstrap_market_shares
+from figures import market_share_plot_data, render_market_shares
+from concentration import build_auditor_ranking
 
 # Set up logging
 log = setup_logging()
 
+# Columns of the prepared data used by the analysis
+ANALYSIS_COLUMNS = ['trans_report_auditor_state', 'auditor_fkey', 'network_group', 'audit_weight']
+
+# Market shares are calculated per country, or per country and report year in panel mode
+COUNTRY_KEYS = ['trans_report_auditor_state']
+PANEL_KEYS = ['trans_report_auditor_state', 'report_year']
+PANEL_METRICS = ['big4_market_share', 'kap10_market_share', 'cr4_market_share', 'hhi']
+
 def main():
     log.info("Performing main analysis...")
     
     # Load the configuration file
     cfg = read_config('config/do_analysis_cfg.yaml')
+    set_verbosity(cfg.get('verbosity', 'INFO'))
+    prepared_data_path = prepared_input_path(cfg)
+    outputs = analysis_outputs(cfg)
+
+    # Skip the analysis if config, prepared data and code are unchanged since a cached run.
+    # The metrics record whether the outputs were restored.
+    cache_cfg = cfg.get('stage_cache')
+    with track_step('stage_cache') as record:
+        cache_key = stage_key(
+            'do_analysis', cfg, [prepared_data_path], [__file__, utils.__file__, schema.__file__, bootstrap.__file__, figures.__file__,
+             concentration.__file__],
+            cache_dir=cache_cfg['cache_dir'] if cache_cfg else None
+        )
+        record['cached'] = restore_outputs(cache_cfg, cache_key, outputs)
+    if record['cached']:
+        write_metrics(cfg['metrics_save_path'])
+        log.info("Performing main analysis and plotting...Done (from stage cache)!")
+        return
     
-    # Load the prepared transparency data using the path from the config file
-    prepared_data = load_data(cfg['prepared_data_save_path'])
-    
-    # Calculate market shares for each group
-    big4_shares = calculate_big4_market_share(prepared_data)
-    kap10_shares = calculate_kap10_market_share(prepared_data)
-    cr4_shares = calculate_cr4_market_share(prepared_data, big4_shares)  # Pass big4_shares as an argument
-    eu_shares = calculate_eu_level_market_shares(prepared_data)
-    
-    # Combine results into one DataFrame
-    market_shares = combine_market_shares(big4_shares, kap10_shares, cr4_shares, eu_shares)
-    
-    # Save the aggregated market shares to a CSV file
-    save_market_shares(market_shares, cfg['aggregated_data_save_path'])
+    # Calculate and save the market shares (and panel and bootstrap intervals, if enabled)
+    results = analyse(cfg)
+    save_results(cfg, results)
 
     # Plot the results
-    plot_market_shares(market_shares, cfg['figure_save_path'], cfg['pickle_save_path'])
+    plot_market_shares(results['market_shares'], cfg['figure_save_path'], cfg['plot_data_save_path'], cfg['countries_order'])
+    store_outputs(cache_cfg, cache_key, outputs)
+    write_metrics(cfg['metrics_save_path'])
     
     log.info("Performing main analysis and plotting...Done!")
 
-def load_data(data_path):
+def prepared_input_path(cfg):
     """
-    Load the prepared transparency data from the specified path.
+    Path of the prepared data the analysis reads: the memory-mapped snapshot if enabled, else the prepared dataset.
     """
-    df = pd.read_csv(data_path)
-    return df
+    if cfg.get('snapshot', {}).get('enabled', False):
+        return cfg['snapshot']['snapshot_path']
+    return data_path(cfg['prepared_data_save_path'], cfg['storage_format'])
+
+def analysis_outputs(cfg):
+    """
+    List the files the analysis saves with the given config.
+    """
+    outputs = [
+        cfg['aggregated_data_save_path'], cfg['auditor_ranking_save_path'], cfg['figure_save_path'], cfg['plot_data_save_path']
+    ]
+    panel_cfg = cfg.get('panel', {})
+    if panel_cfg.get('enabled', False):
+        outputs += [panel_cfg['panel_save_path'], data_path(panel_cfg['panel_manifest_save_path'], cfg['storage_format'])]
+    if cfg.get('bootstrap', {}).get('enabled', False):
+        outputs.append(cfg['bootstrap']['bootstrap_save_path'])
+    return outputs
 
-def calculate_big4_market_share(df):
+def analyse(cfg, prepared_data=None):
     """
-    Calculate market share for Big 4 by country.
+    Calculate the market shares, the auditor ranking (and the bootstrap intervals, if enabled) from the prepared data, which is
+    read from disk unless it is passed as `prepared_data`. The panel, if enabled, is saved here, since it is
+    updated incrementally from the saved panel. Returns the results as a dict of DataFrames for `save_results`.
     """
-    # Step 1: Calculate total PIE audits by counting rows per country
-    country_totals = df.groupby('trans_report_auditor_state').size().reset_index(name='total_pie_audits')
-    print("Country Totals (All Audits):")
-    print(country_totals.head(9))
+    prepared_data_path = prepared_input_path(cfg)
+    panel_cfg = cfg.get('panel', {})
+    bootstrap_cfg = cfg.get('bootstrap', {})
+    keys = PANEL_KEYS if panel_cfg.get('enabled', False) else COUNTRY_KEYS
+    if bootstrap_cfg.get('enabled', False):
+        # The bootstrap resamples the audit counts by resampling unit
+        keys = keys + [BOOTSTRAP_UNITS[bootstrap_cfg['unit']]]
+    columns = list(dict.fromkeys(ANALYSIS_COLUMNS + keys))
+
+    if prepared_data is not None:
+        # Prepared data handed over in memory, with its categories sorted as if it had been read from disk
+        prepared_data = apply_dtypes(prepared_data)
+        validate_schema(prepared_data, columns, 'prepared data')
+        counts = build_audit_counts(prepared_data, keys)
+    elif cfg.get('snapshot', {}).get('enabled', False):
+        # Map the snapshot published by the preparation, its pages are shared with concurrent analyses
+        prepared_data = load_snapshot(prepared_data_path, columns=columns)
+        counts = build_audit_counts(prepared_data, keys)
+    elif cfg.get('backend', 'eager') == 'chunked':
+        # Aggregate the prepared data chunk by chunk into the audit count table
+        counts = build_audit_counts_chunked(prepared_data_path, cfg['chunk_rows'], keys)
+    else:
+        # Load the prepared transparency data using the path from the config file
+        prepared_data = load_data(prepared_data_path, columns=columns)
+        counts = build_audit_counts(prepared_data, keys)
+
+    unit_counts = counts
+    if panel_cfg.get('enabled', False):
+        # Market shares and HHI per country and report year, only recalculated for changed report years
+        panel_version = stage_key('do_analysis_panel', panel_cfg, code_paths=[__file__, utils.__file__, schema.__file__])
+        build_market_share_panel(
+            sum_audit_counts(counts, PANEL_KEYS), panel_cfg['panel_save_path'],
+            data_path(panel_cfg['panel_manifest_save_path'], cfg['storage_format']),
+            panel_cfg['rolling_window'], panel_version
+        )
+    if keys != COUNTRY_KEYS:
+        counts = sum_audit_counts(counts)
     
-    # Step 2: Filter data for Big 4
-    big4_df = df[df['network_group'] == 'Big 4']
-    print("Filtered Big 4 Data:")
-    print(big4_df.head())
+    # Calculate market shares for Big 4, 10KAP, CR4 and the EU aggregate
+    results = {'market_shares': market_shares_from_counts(counts)}
+
+    # Rank the audit firms of every country and the EU, for CRk, top-N and Lorenz/Gini queries (concentration.py)
+    results['auditor_ranking'] = build_auditor_ranking(counts)
+
+    if bootstrap_cfg.get('enabled', False):
+        # Confidence intervals of the market shares from resampled entities or transparency reports
+        results['bootstrap'] = bootstrap_market_shares(
+            sum_audit_counts(unit_counts, COUNTRY_KEYS + [BOOTSTRAP_UNITS[bootstrap_cfg['unit']]]),
+            results['market_shares'], bootstrap_cfg['unit'], bootstrap_cfg['replicates'],
+            bootstrap_cfg['confidence_level'], bootstrap_cfg['batch_size'], bootstrap_cfg.get('workers'),
+            bootstrap_cfg['seed']
+        )
+    return results
+
+def save_results(cfg, results):
+    """
+    Save the aggregated market shares, the auditor ranking (and the bootstrap intervals, if enabled) to CSV files.
+    """
+    save_market_shares(results['market_shares'], cfg['aggregated_data_save_path'])
+    save_market_shares(results['auditor_ranking'], cfg['auditor_ranking_save_path'])
+    if 'bootstrap' in results:
+        save_market_shares(results['bootstrap'], cfg['bootstrap']['bootstrap_save_path'])
+
+@instrument
+def load_data(path, columns=ANALYSIS_COLUMNS):
+    """
+    Load the prepared transparency data from the specified path, reading only the columns used in the analysis.
+    """
+    df = read_data(path, columns=columns)
+    validate_schema(df, columns, 'prepared data')
+    return df
+
+@instrument
+def load_snapshot(path, columns=ANALYSIS_COLUMNS):
+    """
+    Open the memory-mapped snapshot of the prepared data, reading only the columns used in the analysis.
+    The audit weights are read from the shared page cache without a copy, the key and category columns
+    are converted into their pandas dtypes (a copy per process).
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No prepared data snapshot at {path}, enable snapshot in prepare_data_cfg.yaml and rerun it.")
+    df = read_mapped_data(path, columns=columns)
+    validate_schema(df, columns, 'prepared data snapshot')
+    return df
+
+@instrument
+def calculate_market_shares(df):
+    """
+    Calculate Big 4, 10KAP, CR4 and EU-level market shares from the prepared data.
+    The prepared data is scanned once to build the audit count table, all shares are derived from it.
+    """
+    return market_shares_from_counts(build_audit_counts(df))
+
+def market_shares_from_counts(counts):
+    """
+    Calculate Big 4, 10KAP, CR4 and EU-level market shares from the audit count table.
+    """
+    big4_shares = calculate_big4_market_share(counts)
+    kap10_shares = calculate_kap10_market_share(counts)
+    cr4_shares = calculate_cr4_market_share(counts, big4_shares)  # Pass big4_shares as an argument
+    eu_shares = calculate_eu_level_market_shares(counts)
+    return combine_market_shares(big4_shares, kap10_shares, cr4_shares, eu_shares)
+
+@instrument
+def build_audit_counts(df, keys=COUNTRY_KEYS):
+    """
+    Count statutory audits per country (or `keys`), audit firm and network group in one vectorized pass.
+    Every row counts with its audit weight, so joint audits are attributed as set in the preparation.
+    """
+    counts = (
+        df.groupby(keys + ['auditor_fkey', 'network_group'], dropna=False, observed=True, sort=False)['audit_weight']
+        .sum()
+        .reset_index(name='audit_count')
+    )
+    log_frame("Audit Counts (By Country, Firm and Network Group):", counts)
+    return counts
+
+@instrument
+def build_audit_counts_chunked(path, chunk_rows, keys=COUNTRY_KEYS):
+    """
+    Build the audit count table from the prepared data in chunks of `chunk_rows` rows.
+    The counts of each chunk are added up, so the result equals `build_audit_counts` on the full data.
+    """
+    columns = list(dict.fromkeys(ANALYSIS_COLUMNS + keys))
+    counts = []
+    for chunk in iter_data(path, columns=columns, chunk_rows=chunk_rows):
+        validate_schema(chunk, columns, 'prepared data')
+        counts.append(build_audit_counts(chunk, keys))
+    return sum_audit_counts(pd.concat(counts, ignore_index=True), keys)
+
+def sum_audit_counts(counts, keys=COUNTRY_KEYS):
+    """
+    Sum the audit count table per country (or `keys`), audit firm and network group.
+    """
+    return (
+        counts.groupby(keys + ['auditor_fkey', 'network_group'], dropna=False, observed=True, sort=False)['audit_count']
+        .sum()
+        .reset_index()
+    )
+
+def sum_audits_by_country(counts, name, keys=COUNTRY_KEYS):
+    """
+    Sum the audit counts per country (or `keys`) and return them in a column with the given name.
+    """
+    return counts.groupby(keys, observed=True)['audit_count'].sum().reset_index(name=name)
+
+def top_k_audit_counts(firm_totals, k, by=COUNTRY_KEYS):
+    """
+    Sum the audit counts of the k largest audit firms within each group of `by`.
+    Firms are ranked with one sort instead of calling nlargest per group.
+    """
+    ranked = firm_totals.sort_values(by + ['audit_count'], ascending=[True] * len(by) + [False])
+    return ranked.groupby(by, observed=True).head(k).groupby(by, observed=True)['audit_count'].sum()
+
+@instrument
+def calculate_big4_market_share(counts, keys=COUNTRY_KEYS):
+    """
+    Calculate market share for Big 4 by country (or `keys`).
+    """
+    # Step 1: Calculate total PIE audits per country
+    country_totals = sum_audits_by_country(counts, 'total_pie_audits', keys)
     
-    # Step 3: Calculate Big 4 PIE audits by counting rows per country
-    big4_totals = big4_df.groupby('trans_report_auditor_state').size().reset_index(name='big4_pie_audits')
-    print("Big 4 Totals (Audits by Country):")
-    print(big4_totals.head(10))
+    # Step 2: Calculate Big 4 PIE audits per country
+    big4_totals = sum_audits_by_country(counts[counts['network_group'] == 'Big 4'], 'big4_pie_audits', keys)
     
-    # Step 4: Merge with country totals and calculate market share
-    big4_shares = big4_totals.merge(country_totals, on='trans_report_auditor_state')
+    # Step 3: Merge with country totals and calculate market share
+    big4_shares = big4_totals.merge(country_totals, on=keys)
     big4_shares['big4_market_share'] = (big4_shares['big4_pie_audits'] / big4_shares['total_pie_audits']) * 100
-    print("Big 4 Market Shares:")
-    print(big4_shares.head(10))
+    log_frame("Big 4 Market Shares:", big4_shares, rows=10)
     
-    # Step 5: Return final DataFrame
-    return big4_shares[['trans_report_auditor_state', 'big4_market_share']]
+    # Step 4: Return final DataFrame
+    return big4_shares[keys + ['big4_market_share']]
 
-def calculate_kap10_market_share(df):
+@instrument
+def calculate_kap10_market_share(counts, keys=COUNTRY_KEYS):
     """
-    Calculate market share for 10KAP by country, including Big 4 auditors.
+    Calculate market share for 10KAP by country (or `keys`), including Big 4 auditors.
     """
-    # Step 1: Calculate total PIE audits by counting rows per country
-    country_totals = df.groupby('trans_report_auditor_state').size().reset_index(name='total_pie_audits')
-    print("Country Totals (All Audits):")
-    print(country_totals.head())
+    # Step 1: Calculate total PIE audits per country
+    country_totals = sum_audits_by_country(counts, 'total_pie_audits', keys)
     
-    # Step 2: Filter data for 10KAP (including Big 4)
-    kap10_df = df[df['network_group'].isin(['10KAP', 'Big 4'])]
-    print("Filtered 10KAP Data (Including Big 4):")
-    print(kap10_df.head())
-    
-    # Step 3: Calculate 10KAP PIE audits by counting rows per country
-    kap10_totals = kap10_df.groupby('trans_report_auditor_state').size().reset_index(name='kap10_pie_audits')
-    print("10KAP Totals (Audits by Country):")
-    print(kap10_totals.head())
+    # Step 2: Calculate 10KAP PIE audits (including Big 4) per country
+    kap10_totals = sum_audits_by_country(
+        counts[counts['network_group'].isin(['10KAP', 'Big 4'])], 'kap10_pie_audits', keys
+    )
     
-    # Step 4: Merge with country totals and calculate market share
-    kap10_shares = kap10_totals.merge(country_totals, on='trans_report_auditor_state')
+    # Step 3: Merge with country totals and calculate market share
+    kap10_shares = kap10_totals.merge(country_totals, on=keys)
     kap10_shares['kap10_market_share'] = (kap10_shares['kap10_pie_audits'] / kap10_shares['total_pie_audits']) * 100
-    print("10KAP Market Shares:")
-    print(kap10_shares.head())
+    log_frame("10KAP Market Shares:", kap10_shares)
     
-    # Step 5: Return final DataFrame
-    return kap10_shares[['trans_report_auditor_state', 'kap10_market_share']]
+    # Step 4: Return final DataFrame
+    return kap10_shares[keys + ['kap10_market_share']]
 
-def calculate_cr4_market_share(df, big4_shares):
+@instrument
+def calculate_cr4_market_share(counts, big4_shares, keys=COUNTRY_KEYS):
     """
-    Calculate the CR4 market share for the four largest audit firms in each country,
+    Calculate the CR4 market share for the four largest audit firms in each country (or `keys`),
     and check for overlap with Big 4 market share.
     """
     # Step 1: Count statutory audits by firm within each country
-    firm_totals = (
-        df.groupby(['trans_report_auditor_state', 'auditor_fkey'])
-        .size()
-        .reset_index(name='audit_count')
-    )
-    print("Firm Totals (Audit Count by Firm and Country):")
-    print(firm_totals.head())
+    firm_totals = counts.groupby(keys + ['auditor_fkey'], observed=True)['audit_count'].sum().reset_index()
 
     # Step 2: Identify the top 4 firms in each country and sum their audit counts
-    top_4_audits = firm_totals.groupby('trans_report_auditor_state').apply(
-        lambda x: x.nlargest(4, 'audit_count')['audit_count'].sum()
-    ).reset_index(name='cr4_audit_count')
-    print("Top 4 Audits (Summed for Each Country):")
-    print(top_4_audits.head())
+    top_4_audits = top_k_audit_counts(firm_totals, 4, keys).reset_index(name='cr4_audit_count')
 
     # Step 3: Count total statutory audits per country
-    country_totals = df.groupby('trans_report_auditor_state').size().reset_index(name='total_audit_count')
-    print("Total Audits (By Country):")
-    print(country_totals.head())
+    country_totals = sum_audits_by_country(counts, 'total_audit_count', keys)
 
     # Step 4: Merge with total audits and calculate market share
-    cr4_shares = top_4_audits.merge(country_totals, on='trans_report_auditor_state')
+    cr4_shares = top_4_audits.merge(country_totals, on=keys)
     cr4_shares['cr4_market_share'] = (cr4_shares['cr4_audit_count'] / cr4_shares['total_audit_count']) * 100
-    print("CR4 Market Shares (By Country):")
-    print(cr4_shares.head(9))
 
     # Step 5: Merge with Big 4 market shares to check overlap
-    cr4_shares = cr4_shares.merge(big4_shares, on='trans_report_auditor_state', how='left')
+    cr4_shares = cr4_shares.merge(big4_shares, on=keys, how='left')
     cr4_shares['overlap_with_big4'] = cr4_shares['cr4_market_share'] == cr4_shares['big4_market_share']
 
-    print("CR4 Market Shares with Overlap Check (By Country):")
-    print(cr4_shares[['trans_report_auditor_state', 'cr4_market_share', 'big4_market_share', 'overlap_with_big4']])
+    log_frame(
+        "CR4 Market Shares with Overlap Check (By Country):",
+        cr4_shares[keys + ['cr4_market_share', 'big4_market_share', 'overlap_with_big4']],
+        rows=None
+    )
 
     # Step 6: Calculate the number of countries with overlap
     overlap_count = cr4_shares['overlap_with_big4'].sum()
-    print(f"Number of countries with CR4 overlapping with Big 4: {overlap_count}")
+    log.info(f"Number of countries with CR4 overlapping with Big 4: {overlap_count}")
 
     # Step 7: Return final DataFrame with overlap flag
-    return cr4_shares[['trans_report_auditor_state', 'cr4_market_share', 'overlap_with_big4']]
+    return cr4_shares[keys + ['cr4_market_share', 'overlap_with_big4']]
 
-def calculate_eu_level_market_shares(df):
+@instrument
+def calculate_eu_level_market_shares(counts):
     """
     Calculate EU-level market shares for Big 4, 10KAP, and CR4 using statutory audit counts.
     """
-    # Step 1: Calculate total statutory audits in the EU by counting rows
-    eu_totals = len(df)
-    print(f"Total Statutory Audits in the EU: {eu_totals}")
-
-    # Step 2: Filter data for Big 4 and calculate total audits
-    big4_df = df[df['network_group'] == 'Big 4']
-    big4_total = len(big4_df)
-    print(f"Total Big 4 Audits in the EU: {big4_total}")
+    # Step 1: Calculate total statutory audits in the EU
+    eu_totals = counts['audit_count'].sum()
+    log.info(f"Total Statutory Audits in the EU: {eu_totals}")
 
-    # Step 3: Filter data for 10KAP (including Big 4) and calculate total audits
-    kap10_df = df[df['network_group'].isin(['10KAP', 'Big 4'])]
-    kap10_total = len(kap10_df)
-    print(f"Total 10KAP Audits in the EU: {kap10_total}")
+    # Step 2: Calculate total Big 4 and 10KAP (including Big 4) audits
+    big4_total = counts.loc[counts['network_group'] == 'Big 4', 'audit_count'].sum()
+    kap10_total = counts.loc[counts['network_group'].isin(['10KAP', 'Big 4']), 'audit_count'].sum()
 
-    # Step 4: Identify the top 4 firms in the EU (CR4) based on audit counts
-    firm_totals = df.groupby('auditor_fkey').size().reset_index(name='audit_count')
-    print("Total Audits by Firm in the EU:")
-    print(firm_totals.head())
+    # Step 3: Identify the top 4 firms in the EU (CR4) based on audit counts
+    firm_totals = counts.groupby('auditor_fkey')['audit_count'].sum()
+    top_4_audits = firm_totals.nlargest(4).sum()
 
-    top_4_audits = firm_totals.nlargest(4, 'audit_count')['audit_count'].sum()
-    print(f"Total Audits by Top 4 Firms (CR4) in the EU: {top_4_audits}")
-
-    # Step 5: Calculate market shares for Big 4, 10KAP, and CR4
+    # Step 4: Calculate market shares for Big 4, 10KAP, and CR4
     big4_market_share = (big4_total / eu_totals) * 100
     kap10_market_share = (kap10_total / eu_totals) * 100
     cr4_market_share = (top_4_audits / eu_totals) * 100
-    print(f"Big 4 Market Share in the EU: {big4_market_share:.2f}%")
-    print(f"10KAP Market Share in the EU: {kap10_market_share:.2f}%")
-    print(f"CR4 Market Share in the EU: {cr4_market_share:.2f}%")
+    log.info(f"Big 4 Market Share in the EU: {big4_market_share:.2f}%")
+    log.info(f"10KAP Market Share in the EU: {kap10_market_share:.2f}%")
+    log.info(f"CR4 Market Share in the EU: {cr4_market_share:.2f}%")
 
-    # Step 6: Create a DataFrame with EU-level market shares
+    # Step 5: Create a DataFrame with EU-level market shares
     eu_market_shares = pd.DataFrame({
         'trans_report_auditor_state': ['EU'],
         'big4_market_share': [big4_market_share],
@@ -185,18 +353,144 @@ def calculate_eu_level_market_shares(df):
         'cr4_market_share': [cr4_market_share]
     })
 
-    # Step 7: Return the EU-level market shares DataFrame
+    # Step 6: Return the EU-level market shares DataFrame
     return eu_market_shares
 
-def combine_market_shares(big4_shares, kap10_shares, cr4_shares, eu_shares):
+@instrument
+def combine_market_shares(big4_shares, kap10_shares, cr4_shares, eu_shares, keys=COUNTRY_KEYS):
     """
     Combine market shares for Big 4, 10KAP, CR4, and EU-level into one DataFrame.
     """
-    market_shares = big4_shares.merge(kap10_shares, on='trans_report_auditor_state', how='outer')
-    market_shares = market_shares.merge(cr4_shares, on='trans_report_auditor_state', how='outer')
+    market_shares = big4_shares.merge(kap10_shares, on=keys, how='outer')
+    market_shares = market_shares.merge(cr4_shares, on=keys, how='outer')
     market_shares = pd.concat([market_shares, eu_shares], ignore_index=True)
     return market_shares
 
+@instrument
+def calculate_hhi(counts, keys=COUNTRY_KEYS):
+    """
+    Calculate the Herfindahl-Hirschman Index (sum of the squared audit firm market shares in %,
+    from 0 to 10,000) by country (or `keys`).
+    """
+    firm_totals = counts.groupby(keys + ['auditor_fkey'], observed=True)['audit_count'].sum().reset_index()
+    firm_totals = firm_totals.merge(sum_audits_by_country(counts, 'total_audit_count', keys), on=keys)
+    firm_totals['squared_share'] = (firm_totals['audit_count'] / firm_totals['total_audit_count'] * 100) ** 2
+    return firm_totals.groupby(keys, observed=True)['squared_share'].sum().reset_index(name='hhi')
+
+@instrument
+def calculate_panel_market_shares(counts):
+    """
+    Calculate Big 4, 10KAP and CR4 market shares and the HHI per country and report year, including the EU,
+    from the audit count table by country, report year, firm and network group. All report years are
+    calculated in one grouped pass.
+    """
+    # The EU is added as one more country, so its shares equal those of calculate_eu_level_market_shares
+    counts = counts.assign(trans_report_auditor_state=counts['trans_report_auditor_state'].astype(object))
+    counts = pd.concat([counts, counts.assign(trans_report_auditor_state='EU')], ignore_index=True)
+
+    big4_shares = calculate_big4_market_share(counts, PANEL_KEYS)
+    kap10_shares = calculate_kap10_market_share(counts, PANEL_KEYS)
+    cr4_shares = calculate_cr4_market_share(counts, big4_shares, PANEL_KEYS)
+    hhi = calculate_hhi(counts, PANEL_KEYS)
+
+    panel = big4_shares.merge(kap10_shares, on=PANEL_KEYS, how='outer')
+    panel = panel.merge(cr4_shares, on=PANEL_KEYS, how='outer')
+    panel = panel.merge(hhi, on=PANEL_KEYS, how='outer')
+    panel['report_year'] = panel['report_year'].astype('int64')
+    return panel
+
+@instrument
+def calculate_panel_changes(panel, rolling_window, report_years):
+    """
+    Add the year-over-year change and the rolling mean over `rolling_window` report years of every panel metric
+    for the given report years. Only the preceding years within the window are read from the panel,
+    and missing report years count as missing values.
+    """
+    history = panel[panel['report_year'] > min(report_years) - max(rolling_window, 2)]
+    wide = history.pivot(index='report_year', columns='trans_report_auditor_state', values=PANEL_METRICS)
+    wide = wide.reindex(range(wide.index.min(), wide.index.max() + 1))
+    yoy_changes = (wide - wide.shift(1)).stack(future_stack=True).add_suffix('_yoy_change')
+    rolling_means = wide.rolling(rolling_window, min_periods=1).mean().stack(future_stack=True).add_suffix('_rolling_mean')
+
+    changes = panel[panel['report_year'].isin(report_years)]
+    changes = changes.merge(yoy_changes.reset_index(), on=PANEL_KEYS, how='left')
+    changes = changes.merge(rolling_means.reset_index(), on=PANEL_KEYS, how='left')
+    return changes
+
+@instrument
+def year_fingerprints(counts):
+    """
+    Hash the audit count table of each report year into one fingerprint per report_year.
+    The row hashes are summed, so the fingerprint does not depend on the row order.
+    """
+    row_hashes = pd.util.hash_pandas_object(counts, index=False)
+    fingerprints = row_hashes.groupby(counts['report_year']).sum()
+    return pd.DataFrame({
+        'report_year': fingerprints.index.astype('int64'),
+        'fingerprint': fingerprints.to_numpy().view('int64')
+    })
+
+@instrument
+def build_market_share_panel(counts, panel_path, manifest_path, rolling_window, panel_version):
+    """
+    Build the market share panel by country and report year with year-over-year changes and rolling means,
+    and save it to `panel_path`. Only report years whose audit counts changed since the last panel are
+    recalculated, and their changes and rolling means only for the years whose window includes such a year.
+    Falls back to a full calculation if there is no panel or it was built with a different config or code version.
+    """
+    fingerprints = year_fingerprints(counts)
+    fingerprints['panel_version'] = panel_version
+
+    previous = None
+    if os.path.exists(panel_path) and os.path.exists(manifest_path):
+        previous = read_data(manifest_path)
+        if not (previous['panel_version'] == panel_version).all():
+            log.info("Market share panel was built with a different config or code. Calculating all report years.")
+            previous = None
+
+    if previous is None:
+        panel = None
+        changed_years = fingerprints['report_year']
+    else:
+        comparison = fingerprints.merge(
+            previous[['report_year', 'fingerprint']], on='report_year',
+            how='outer', suffixes=('', '_previous'), indicator=True
+        )
+        changed_years = comparison.loc[
+            (comparison['_merge'] != 'both') | (comparison['fingerprint'] != comparison['fingerprint_previous']),
+            'report_year'
+        ]
+        log.info(f"Incremental panel: {len(changed_years)} new, modified or removed report years.")
+        panel = pd.read_csv(panel_path, float_precision='round_trip')
+        panel = panel[~panel['report_year'].isin(changed_years)]
+
+    # Market shares and HHI of the changed report years
+    base_columns = PANEL_KEYS + ['big4_market_share', 'kap10_market_share', 'cr4_market_share', 'overlap_with_big4', 'hhi']
+    changed_counts = counts[counts['report_year'].isin(changed_years)]
+    base = [panel[base_columns]] if panel is not None and not panel.empty else []
+    if not changed_counts.empty:
+        base.append(calculate_panel_market_shares(changed_counts))
+    base = pd.concat(base, ignore_index=True)
+
+    # Year-over-year changes and rolling means of the report years whose window includes a changed year
+    window = max(rolling_window, 2)
+    affected_years = [
+        year for year in fingerprints['report_year'] if any(0 <= year - changed < window for changed in changed_years)
+    ]
+    if affected_years:
+        changes = calculate_panel_changes(base, rolling_window, affected_years)
+        panel = changes if panel is None else pd.concat(
+            [panel[~panel['report_year'].isin(affected_years)], changes], ignore_index=True
+        )
+    panel = panel.sort_values(['report_year', 'trans_report_auditor_state'], ignore_index=True)
+
+    os.makedirs(os.path.dirname(panel_path), exist_ok=True)
+    panel.to_csv(panel_path, index=False)
+    write_data(fingerprints, manifest_path)
+    log.info(f"Market share panel saved to {panel_path}.")
+    return panel
+
+@instrument
 def save_market_shares(df, save_path):
     """
     Save the aggregated market shares to a CSV file.
@@ -205,66 +499,22 @@ def save_market_shares(df, save_path):
     df.to_csv(save_path, index=False)
     log.info(f"Market shares saved to {save_path}.")
 
-def plot_market_shares(market_shares, save_path, pickle_path):
+@instrument
+def plot_market_shares(market_shares, save_path, plot_data_path, countries_order):
     """
-    Create a patterned bar chart for Big 4, CR4, and 10KAP market shares by country (including EU),
-    and save the figure as both PNG and pickle formats.
+    Create a bar chart for Big 4, CR4, and 10KAP market shares by country (including EU) in the order of
+    `countries_order`, save it as PNG and save the plotted table as CSV, so the figure can be re-rendered from it.
     """
     # Sort the market shares to match the desired country order
-    countries_order = ['DK', 'CY', 'FI', 'SE', 'LU', 'BE', 'EE', 'AT', 'NO', 'NL', 'IT',
-                       'ES', 'IE', 'DE', 'MT', 'LT', 'HU', 'EU', 'LV', 'CZ', 'HR', 'SI',
-                       'SK', 'FR', 'PL', 'PT', 'EL', 'RO', 'BG']
-    market_shares['sort_order'] = market_shares['trans_report_auditor_state'].apply(lambda x: countries_order.index(x))
-    market_shares = market_shares.sort_values(by='sort_order')
-    
-    # Extract data for plotting
-    countries = market_shares['trans_report_auditor_state']
-    big4 = market_shares['big4_market_share']
-    cr4 = market_shares['cr4_market_share']
-    kap10 = market_shares['kap10_market_share']
-    
-    # Define bar width and x-coordinates
-    x = range(len(countries))
-    bar_width = 0.25
-
-    # Plot settings
-    fig, ax = plt.subplots(figsize=(14, 7))
-
-    # Add bars with appropriate colors
-    for i, country in enumerate(countries):
-        if country == 'EU':
-            # Highlight EU with different red shades
-            ax.bar(i, big4.iloc[i], width=bar_width, color='darkred', align='center', label='Big 4 (EU)' if i == 0 else "")
-            ax.bar(i + bar_width, cr4.iloc[i], width=bar_width, color='red', align='center', label='CR4 (EU)' if i == 0 else "")
-            ax.bar(i + 2 * bar_width, kap10.iloc[i], width=bar_width, color='lightcoral', align='center', label='10KAP (EU)' if i == 0 else "")
-        else:
-            # Default colors for other countries
-            ax.bar(i, big4.iloc[i], width=bar_width, color='darkblue', align='center', label='Big 4' if i == 0 else "")
-            ax.bar(i + bar_width, cr4.iloc[i], width=bar_width, color='lightblue', align='center', label='CR4' if i == 0 else "")
-            ax.bar(i + 2 * bar_width, kap10.iloc[i], width=bar_width, color='gray', align='center', label='10KAP' if i == 0 else "")
-
-    # Add labels, title, and legend
-    ax.set_xlabel('Country', fontsize=12)
-    ax.set_ylabel('Market Share (%)', fontsize=12)
-    ax.set_xticks([i + bar_width for i in x])
-    ax.set_xticklabels(countries, rotation=90)
-    
-    # Define legend below the graph
-    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15), fancybox=True, shadow=True, ncol=3)
-    
-    # Save the figure as a PNG
-    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-    plt.tight_layout()
-    plt.savefig(save_path)
+    plot_data = market_share_plot_data(market_shares, countries_order)
+    unordered = set(plot_data['trans_report_auditor_state']) - set(countries_order)
+    if unordered:
+        log.warning(f"Countries missing from countries_order are plotted last: {sorted(unordered)}")
+
+    # Save the plotted table and the figure
+    save_market_shares(plot_data, plot_data_path)
+    render_market_shares(plot_data, save_path)
     log.info(f"Figure saved to {save_path}.")
     
-    # Save the figure as a pickle file
-    os.makedirs(os.path.dirname(pickle_path), exist_ok=True)
-    with open(pickle_path, 'wb') as f:
-        pickle.dump(fig, f)
-    log.info(f"Figure saved as pickle to {pickle_path}.")
-    
-    plt.show()
-    
 if __name__ == "__main__":
     main()
\ No newline at end of file
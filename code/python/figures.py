@@ -0,0 +1,62 @@
+# --- Header -------------------------------------------------------------------
+# Render the market share figure from its plotted table, without a display
+# (used by do_analysis.py and doc/paper.qmd)
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import os
+
+# numpy and matplotlib are imported in the functions drawing the figure, so importing this module loads neither
+
+# Plotted series: column, legend label, color for the countries and color for the EU
+MARKET_SHARE_SERIES = [
+    ('big4_market_share', 'Big 4', 'darkblue', 'darkred'),
+    ('cr4_market_share', 'CR4', 'lightblue', 'red'),
+    ('kap10_market_share', '10KAP', 'gray', 'lightcoral'),
+]
+BAR_WIDTH = 0.25
+
+def market_share_plot_data(market_shares, countries_order):
+    '''
+    Returns the plotted table: the market shares of every series in the order of `countries_order`.
+    Countries missing from the order are plotted after the ordered ones.
+    '''
+    columns = ['trans_report_auditor_state'] + [column for column, _, _, _ in MARKET_SHARE_SERIES]
+    plot_data = market_shares[columns].astype({'trans_report_auditor_state': object})
+    order = {country: position for position, country in enumerate(countries_order)}
+    plot_data = plot_data.assign(sort_order=plot_data['trans_report_auditor_state'].map(order))
+    return plot_data.sort_values(['sort_order', 'trans_report_auditor_state'], na_position='last') \
+        .drop(columns='sort_order').reset_index(drop=True)
+
+def draw_market_shares(ax, plot_data):
+    '''
+    Draws the grouped bar chart of the plotted table on `ax`, with one bar call per series.
+    The EU aggregate is highlighted in shades of red.
+    '''
+    import numpy as np
+    x = np.arange(len(plot_data))
+    is_eu = (plot_data['trans_report_auditor_state'] == 'EU').to_numpy()
+    for i, (column, label, color, eu_color) in enumerate(MARKET_SHARE_SERIES):
+        ax.bar(x + i * BAR_WIDTH, plot_data[column], width=BAR_WIDTH, align='center',
+               color=np.where(is_eu, eu_color, color), label=label)
+
+    # Add labels and the legend below the graph
+    ax.set_xlabel('Country', fontsize=12)
+    ax.set_ylabel('Market Share (%)', fontsize=12)
+    ax.set_xticks(x + BAR_WIDTH)
+    ax.set_xticklabels(plot_data['trans_report_auditor_state'], rotation=90)
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.15), fancybox=True, shadow=True, ncol=3)
+    return ax
+
+def render_market_shares(plot_data, save_path, figsize=(14, 7)):
+    '''
+    Renders the market share figure to an image file. The figure is not registered with pyplot,
+    so nothing is shown and no figures pile up when rendering many of them.
+    '''
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=figsize)
+    draw_market_shares(fig.subplots(), plot_data)
+    fig.tight_layout()
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    fig.savefig(save_path)
+    return save_path
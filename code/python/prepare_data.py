@@ -4,52 +4,270 @@
 # (C) Melisa Mazaeva - See LICENSE file for details
 # ------------------------------------------------------------------------------
 
+import os
+import numpy as np
 import pandas as pd
-from utils import read_config, setup_logging
+import utils
+import schema
+from utils import (
+    read_config, setup_logging, set_verbosity, data_path, read_data, write_data, iter_data, write_data_chunks,
+    write_mapped_data, apply_dtypes, replace_values, fill_missing, instrument, track_step, write_metrics
+)
+from stage_cache import stage_key, restore_outputs, store_outputs
+from schema import PULLED_COLUMNS, PREPARED_COLUMNS, validate_schema, memory_usage_mb
+import validation
+from validation import JOINT_AUDIT_KEYS, check_rules, rule_columns, write_validation_report
 
 log = setup_logging()
+
 def main():
     log.info("Preparing data for analysis ...")
     cfg = read_config('config/prepare_data_cfg.yaml')
+    set_verbosity(cfg.get('verbosity', 'INFO'))
+    prepare(cfg)
+    write_metrics(cfg['metrics_save_path'])
+    log.info("Preparing data for analysis ... Done!")
+
+def prepare(cfg, transparency_data=None, save_prepared=True):
+    """
+    Prepare the pulled data as set in the config. The pulled data is read from disk unless it is passed
+    as `transparency_data`. Returns the prepared data, or None if it was restored from the stage cache or
+    prepared chunk by chunk (read it from the prepared data path). With `save_prepared=False`, the prepared
+    data is only returned and not saved (this also skips the stage cache, which stores saved files).
+    If the snapshot is enabled, the saved prepared data is also published as a memory-mapped snapshot.
+    """
+    pulled_data_path = data_path(cfg['audit_analytics_save_path'], cfg['storage_format'])
+    prepared_data_path = data_path(cfg['prepared_data_save_path'], cfg['storage_format'])
+    manifest_path = data_path(cfg['prepared_manifest_save_path'], cfg['storage_format'])
+    outputs = [prepared_data_path, cfg['validation_report_save_path']]
+    if cfg.get('incremental', False):
+        if not save_prepared:
+            raise ValueError("Incremental preparation merges into the saved prepared data, it cannot skip saving it.")
+        outputs.append(manifest_path)
+    snapshot_cfg = cfg.get('snapshot', {})
+    if snapshot_cfg.get('enabled', False):
+        if cfg.get('backend', 'eager') == 'chunked':
+            raise ValueError("The snapshot is only published by the 'eager' backend.")
+        outputs.append(snapshot_cfg['snapshot_save_path'])
+
+    # Skip the preparation if config, pulled data and code are unchanged since a cached run.
+    # The metrics record whether the outputs were restored.
+    cache_cfg = cfg.get('stage_cache') if save_prepared else None
+    with track_step('stage_cache') as record:
+        cache_key = stage_key(
+            'prepare_data', cfg, [pulled_data_path], [__file__, utils.__file__, schema.__file__, validation.__file__],
+            cache_dir=cache_cfg['cache_dir'] if cache_cfg else None
+        )
+        record['cached'] = restore_outputs(cache_cfg, cache_key, outputs)
+    if record['cached']:
+        log.info("Prepared data restored from the stage cache.")
+        return None
+
+    if cfg.get('backend', 'eager') == 'chunked':
+        # Stream the pulled data through the preparation steps in bounded memory
+        if cfg.get('incremental', False):
+            raise ValueError("Incremental preparation is only available with the 'eager' backend.")
+        prepare_chunked(
+            pulled_data_path, prepared_data_path, cfg['network_taxonomy'], cfg['chunk_rows'], cfg['joint_audits']
+        )
+        log.info(f"Prepared data saved to {prepared_data_path}")
+        write_validation_report(cfg['validation_report_save_path'])
+        store_outputs(cache_cfg, cache_key, outputs)
+        return None
 
     # Load the pulled data
-    transparency_data = pd.read_csv(cfg['audit_analytics_save_path'])
+    if transparency_data is None:
+        with track_step('load_pulled_data') as record:
+            transparency_data = read_data(pulled_data_path, columns=PULLED_COLUMNS)
+            record['rows_out'] = len(transparency_data)
+    validate_schema(transparency_data, PULLED_COLUMNS, 'pulled data')
+    log.info(f"Pulled data loaded with {memory_usage_mb(transparency_data):.1f} MB in memory")
     initial_obs_count = len(transparency_data)
     log.info(f"Initial number of observations after pulling data: {initial_obs_count}")
 
-    # Standardize Greece abbreviation
-    transparency_data = standardize_greece_abbreviation(transparency_data)
-
-    # Verify disclosed PIEs alignment with listed entities
-    transparency_data = verify_disclosed_pies_alignment(transparency_data)
+    if cfg.get('incremental', False):
+        # Only run new or modified transparency reports through the cleaning steps
+        prepare_version = stage_key(
+            'prepare_data_incremental', cfg, code_paths=[__file__, utils.__file__, schema.__file__, validation.__file__]
+        )
+        transparency_data = prepare_incremental(
+            transparency_data, cfg['network_taxonomy'], prepared_data_path, manifest_path, prepare_version
+        )
+    else:
+        transparency_data = prepare_transparency_data(transparency_data, cfg['network_taxonomy'])
 
-    # Check and handle blank values in vital fields
-    vital_fields = ['transparency_report_fkey', 'entity_map_fkey', 'auditor_fkey', 'trans_report_auditor_state']
-    transparency_data = check_and_handle_blanks(transparency_data, vital_fields)
+    # Attribute joint audits to their audit firms with fractional audit weights.
+    # They depend on other reports, so they are attached after the incremental merge.
+    transparency_data = assign_joint_audit_weights(transparency_data, cfg['joint_audits'])
+    # Sorted categories as in the saved prepared data, for stages taking the prepared data over in memory
+    transparency_data = apply_dtypes(transparency_data)
+    validate_schema(transparency_data, PREPARED_COLUMNS, 'prepared data')
+    write_validation_report(cfg['validation_report_save_path'])
 
-    # Ensure rows with NUMBER_OF_DISCLOSED_PIES > 0
-    transparency_data = filter_disclosed_pies(transparency_data)
+    # Save the prepared dataset
+    if save_prepared:
+        with track_step('save_prepared_data', len(transparency_data)):
+            write_data(transparency_data, prepared_data_path)
+        log.info(f"Prepared data saved to {prepared_data_path}")
+        if snapshot_cfg.get('enabled', False):
+            # Replaced in one rename: analyses that have the previous snapshot open keep reading it unchanged
+            with track_step('publish_snapshot', len(transparency_data)):
+                write_mapped_data(transparency_data, snapshot_cfg['snapshot_save_path'])
+            log.info(f"Prepared data snapshot published to {snapshot_cfg['snapshot_save_path']}")
+        store_outputs(cache_cfg, cache_key, outputs)
+    return transparency_data
+
+@instrument(filter_step=True)
+def prepare_transparency_data(transparency_data, taxonomy):
+    """
+    Run the pulled transparency data through the standardization, verification and cleaning steps,
+    and map the auditor networks into the groups of the network taxonomy.
+    """
+    # Standardize Greece abbreviation
+    transparency_data = standardize_greece_abbreviation(transparency_data)
 
-    # Check for duplicates in entity_map_fkey
-    check_for_joint_audits(transparency_data)
+    # Check the validation rules (blank vital fields, disclosed PIEs, PIE alignment, joint audits and
+    # unknown networks) and drop the rows with blank vital fields or without disclosed PIEs
+    transparency_data = validate_transparency_data(transparency_data, taxonomy)
 
     # Handle missing Auditor Network values
-    transparency_data['auditor_network'] = transparency_data['auditor_network'].fillna('Other (Blank)')
-    missing_networks = transparency_data['auditor_network'].value_counts().get('Other (Blank)', 0)
+    with track_step('fill_missing_auditor_networks', len(transparency_data)):
+        transparency_data['auditor_network'] = fill_missing(transparency_data['auditor_network'], taxonomy['blank_group'])
+        missing_networks = transparency_data['auditor_network'].value_counts().get(taxonomy['blank_group'], 0)
     log.info(f"Number of observations with missing Auditor Network: {missing_networks}")
 
     # Map duplicate auditor networks to standardized names
-    transparency_data = standardize_auditor_network_names(transparency_data)
+    transparency_data = standardize_auditor_network_names(transparency_data, taxonomy['aliases'])
 
     # Map auditor networks into groups
-    transparency_data = map_auditor_networks(transparency_data)
+    transparency_data = map_auditor_networks(transparency_data, taxonomy)
 
-    # Save the prepared dataset
-    transparency_data.to_csv(cfg['prepared_data_save_path'], index=False)
-    log.info(f"Prepared data saved to {cfg['prepared_data_save_path']}")
+    return transparency_data
 
-    log.info("Preparing data for analysis ... Done!")
+@instrument
+def report_fingerprints(df):
+    """
+    Hash the rows of each transparency report into one fingerprint per transparency_report_fkey.
+    The row hashes are summed, so the fingerprint does not depend on the row order.
+    """
+    row_hashes = pd.util.hash_pandas_object(df[PULLED_COLUMNS], index=False)
+    fingerprints = row_hashes.groupby(df['transparency_report_fkey'].to_numpy(), dropna=True).sum()
+    return pd.DataFrame({
+        'transparency_report_fkey': fingerprints.index.astype('int64'),
+        'fingerprint': fingerprints.to_numpy().view('int64')
+    })
+
+@instrument
+def prepare_incremental(transparency_data, taxonomy, prepared_data_path, manifest_path, prepare_version):
+    """
+    Prepare only new or modified transparency reports and merge them into the last prepared snapshot.
+    Reports that are no longer in the pulled data are removed from the snapshot. Falls back to a full
+    preparation if there is no snapshot or it was prepared with a different config or code version.
+    """
+    fingerprints = report_fingerprints(transparency_data)
+    fingerprints['prepare_version'] = prepare_version
+
+    previous = None
+    if os.path.exists(prepared_data_path) and os.path.exists(manifest_path):
+        previous = read_data(manifest_path)
+        if not (previous['prepare_version'] == prepare_version).all():
+            log.info("Prepared snapshot was created with a different config or code. Preparing all reports.")
+            previous = None
+
+    if previous is None:
+        prepared_data = prepare_transparency_data(transparency_data, taxonomy)
+    else:
+        comparison = fingerprints.merge(
+            previous[['transparency_report_fkey', 'fingerprint']], on='transparency_report_fkey',
+            how='outer', suffixes=('', '_previous'), indicator=True
+        )
+        changed_keys = comparison.loc[
+            (comparison['_merge'] == 'left_only') |
+            ((comparison['_merge'] == 'both') & (comparison['fingerprint'] != comparison['fingerprint_previous'])),
+            'transparency_report_fkey'
+        ]
+        removed_keys = comparison.loc[comparison['_merge'] == 'right_only', 'transparency_report_fkey']
+        log.info(f"Incremental preparation: {len(changed_keys)} new or modified and {len(removed_keys)} removed transparency reports.")
+
+        snapshot = read_data(prepared_data_path)
+        snapshot = snapshot[~snapshot['transparency_report_fkey'].isin(pd.concat([changed_keys, removed_keys]))]
+        delta = transparency_data[transparency_data['transparency_report_fkey'].isin(changed_keys)].copy()
+        if delta.empty:
+            prepared_data = snapshot
+        else:
+            # Categoricals with different categories are joined as object columns, so the schema is re-applied
+            prepared_data = apply_dtypes(
+                pd.concat([snapshot, prepare_transparency_data(delta, taxonomy)], ignore_index=True)
+            )
+
+    write_data(fingerprints, manifest_path)
+    return prepared_data
 
+@instrument
+def prepare_chunked(pulled_data_path, prepared_data_path, taxonomy, chunk_rows, joint_audit_rule):
+    """
+    Prepare the pulled data chunk by chunk and stream the prepared chunks to `prepared_data_path`.
+
+    The row-level steps and validation rules run on each chunk. The validation rules across transparency
+    reports (PIE alignment and joint audits) only keep the integer keys they need, so memory stays bounded
+    by the chunk size plus the key columns. The joint audit weights need the keys of all chunks, so they are
+    attached in a second pass over the prepared chunks. The result is identical to
+    `prepare_transparency_data` followed by `assign_joint_audit_weights`.
+    """
+    report_keys = []
+    stem, extension = os.path.splitext(prepared_data_path)
+    unweighted_path = f"{stem}_unweighted{extension}"
+
+    def prepared_chunks():
+        for chunk in iter_data(pulled_data_path, columns=PULLED_COLUMNS, chunk_rows=chunk_rows):
+            validate_schema(chunk, PULLED_COLUMNS, 'pulled data')
+            chunk = standardize_greece_abbreviation(chunk)
+
+            # Keep the keys for the validation rules across transparency reports
+            keep = check_rules(chunk, taxonomy, scope='row')
+            report_keys.append(chunk[rule_columns('report')].assign(keep=keep))
+
+            chunk = chunk.take(np.flatnonzero(keep))
+            chunk['auditor_network'] = fill_missing(chunk['auditor_network'], taxonomy['blank_group'])
+            chunk = standardize_auditor_network_names(chunk, taxonomy['aliases'])
+            chunk = map_auditor_networks(chunk, taxonomy)
+            yield chunk
+
+    log.info(f"Preparing data in chunks of {chunk_rows} rows ...")
+    write_data_chunks(prepared_chunks(), unweighted_path)
+
+    # Validation rules across transparency reports, on the keys collected from all chunks
+    report_keys = pd.concat(report_keys, ignore_index=True)
+    check_rules(report_keys, taxonomy, scope='report', keep=report_keys['keep'].to_numpy())
+
+    # Second pass: attach the joint audit weights from the audit firm counts of all chunks
+    joint_auditors = report_keys.loc[report_keys['keep'], JOINT_AUDIT_KEYS + ['auditor_fkey']] \
+        .groupby(JOINT_AUDIT_KEYS, dropna=False)['auditor_fkey'].nunique().reset_index(name='joint_auditors')
+    del report_keys
+    joint_rows = joint_auditors.loc[joint_auditors['joint_auditors'] > 1, 'joint_auditors'].sum()
+    log.info(f"Joint audits attributed with rule '{joint_audit_rule}': {joint_rows} rows belong to jointly audited entities.")
+
+    def weighted_chunks():
+        for chunk in iter_data(unweighted_path, chunk_rows=chunk_rows):
+            n_auditors = chunk[JOINT_AUDIT_KEYS].merge(joint_auditors, on=JOINT_AUDIT_KEYS, how='left')['joint_auditors']
+            chunk['audit_weight'] = joint_audit_weights(n_auditors, joint_audit_rule).to_numpy()
+            validate_schema(chunk, PREPARED_COLUMNS, 'prepared data')
+            yield chunk
+
+    write_data_chunks(weighted_chunks(), prepared_data_path)
+    os.remove(unweighted_path)
+
+@instrument(filter_step=True)
+def validate_transparency_data(df, taxonomy):
+    """
+    Check all validation rules in one pass (see validation.py) and drop the rows violating a 'drop' rule.
+    The violations are collected for the validation report.
+    """
+    keep = check_rules(df, taxonomy)
+    # take returns a new frame rather than a slice of df, so the later column assignments do not warn
+    return df if keep.all() else df.take(np.flatnonzero(keep))
+
+@instrument
 def standardize_greece_abbreviation(df):
     """
     Replace 'GR' with 'EL' for Greece in the trans_report_auditor_state column.
@@ -57,128 +275,74 @@ def standardize_greece_abbreviation(df):
     greece_count = df[df['trans_report_auditor_state'] == 'GR'].shape[0]
     if greece_count > 0:
         log.info(f"Found {greece_count} rows with 'GR' abbreviation for Greece. Replacing with 'EL'.")
-        df['trans_report_auditor_state'] = df['trans_report_auditor_state'].replace('GR', 'EL')
+        df['trans_report_auditor_state'] = replace_values(df['trans_report_auditor_state'], {'GR': 'EL'})
     else:
         log.info("No 'GR' abbreviation found for Greece. No replacements made.")
     return df
 
-def verify_disclosed_pies_alignment(df):
+def count_joint_auditors(df):
     """
-    Verify that the number of unique entity_map_fkey matches number_of_disclosed_pies
-    for each transparency_report_fkey.
+    Count the distinct audit firms that list each entity in the same report year, for every row.
+    An entity listed twice by the same audit firm is not a joint audit.
     """
-    # Group by transparency_report_fkey and count unique entity_map_fkey
-    entity_counts = df.groupby('transparency_report_fkey')['entity_map_fkey'].nunique().reset_index()
-    entity_counts.columns = ['transparency_report_fkey', 'entity_count']
-
-    # Merge with original dataframe to compare counts
-    merged_df = df.merge(entity_counts, on='transparency_report_fkey', how='left')
-
-    # Check for mismatches
-    overreported = merged_df[merged_df['entity_count'] > merged_df['number_of_disclosed_pies']]
-    underreported = merged_df[merged_df['entity_count'] < merged_df['number_of_disclosed_pies']]
-
-    if not overreported.empty:
-        log.warning(f"{len(overreported)} transparency reports include more entities than disclosed PIEs.")
-        log.warning("This indicates potential inclusion of non-PIE entities.")
-        log.warning(overreported[['transparency_report_fkey', 'entity_count', 'number_of_disclosed_pies']].drop_duplicates())
-
-    if not underreported.empty:
-        log.warning(f"{len(underreported)} transparency reports include fewer entities than disclosed PIEs.")
-        log.warning("This indicates potential missing PIE entities in the dataset.")
-        log.warning(underreported[['transparency_report_fkey', 'entity_count', 'number_of_disclosed_pies']].drop_duplicates())
-
-    if overreported.empty and underreported.empty:
-        log.info("All transparency reports have consistent counts of disclosed PIEs and listed entities.")
-
-    return df
+    return df.groupby(JOINT_AUDIT_KEYS, dropna=False)['auditor_fkey'].transform('nunique')
 
-def check_and_handle_blanks(df, fields):
+def joint_audit_weights(joint_auditors, rule):
     """
-    Check for blank values in specified fields and remove rows with blanks.
+    Convert the number of audit firms listing an entity into the audit weight of each of them:
+    'split' counts 1/n of an audit for each of n joint auditors, 'full' counts a full audit for each
+    (as in the original replication) and 'exclude' drops jointly audited entities.
     """
-    initial_count = len(df)
-    for field in fields:
-        blank_count = df[field].isnull().sum()
-        if blank_count > 0:
-            log.warning(f"Found {blank_count} blank values in '{field}'. These rows will be dropped.")
-            df = df[df[field].notnull()]
-    final_count = len(df)
-    log.info(f"Rows removed due to blank values: {initial_count - final_count}")
-    return df
-
-
-def filter_disclosed_pies(df):
+    if rule == 'split':
+        return 1 / joint_auditors.astype('float64')
+    if rule == 'full':
+        return pd.Series(1.0, index=joint_auditors.index)
+    if rule == 'exclude':
+        return (joint_auditors == 1).astype('float64')
+    raise ValueError(f"Unknown joint audit rule '{rule}'. Use 'split', 'full' or 'exclude'.")
+
+@instrument
+def assign_joint_audit_weights(df, rule):
     """
-    Ensure that only rows with NUMBER_OF_DISCLOSED_PIES > 0 are included.
+    Attach the fractional audit weight of every row (audit_weight) according to the joint audit rule.
+    The analysis sums these weights instead of counting rows.
     """
-    initial_count = len(df)
-    df = df[df['number_of_disclosed_pies'] > 0]
-    filtered_count = initial_count - len(df)
-    if filtered_count > 0:
-        log.info(f"{filtered_count} rows were filtered out because NUMBER_OF_DISCLOSED_PIES <= 0.")
-    else:
-        log.info("No rows were filtered out based on NUMBER_OF_DISCLOSED_PIES.")
+    joint_auditors = count_joint_auditors(df)
+    df['audit_weight'] = joint_audit_weights(joint_auditors, rule).to_numpy()
+    log.info(f"Joint audits attributed with rule '{rule}': {(joint_auditors > 1).sum()} rows belong to jointly audited entities.")
     return df
 
-
-def check_for_joint_audits(df):
+@instrument
+def standardize_auditor_network_names(df, aliases):
     """
-    Check for duplicates in entity_map_fkey to identify potential joint audits.
+    Standardize duplicate auditor network names to a single name, using the aliases from the network taxonomy.
     """
-    duplicate_count = df['entity_map_fkey'].duplicated().sum()
-    if duplicate_count > 0:
-        log.warning(f"Potential joint audits detected: {duplicate_count} entities appear in multiple transparency reports.")
-    else:
-        log.info("No potential joint audits detected. Each entity is unique in the dataset.")
+    df['auditor_network'] = replace_values(df['auditor_network'], aliases)
+    log.info(f"Auditor Network names standardized: {aliases}")
+    return df
 
-def standardize_auditor_network_names(df):
+@instrument
+def map_auditor_networks(df, taxonomy):
     """
-    Standardize duplicate auditor network names to a single name.
+    Group auditor networks into the groups of the network taxonomy (by default Big Four, 10KAP (includes Big Four firms),
+    Unaffiliated (not subset of BIG 4 and 10KAP), and Other (Blank)).
+    Each unique network name is looked up once, the rows only take over the group of their network.
     """
-    duplicate_map = {
-        '|Mazars Worldwide|Praxity Global Alliance|': '|Mazars Worldwide|',
-        '|Praxity Global Alliance|TALENZ International|': '|Praxity Global Alliance|',
-        '|Morison KSi|': '|Morison International|'
-    }
-    df['auditor_network'] = df['auditor_network'].replace(duplicate_map)
-    log.info(f"Auditor Network names standardized: {duplicate_map}")
-    return df
-
-def map_auditor_networks(df):
-    """
-    Group auditor networks into Big Four, 10KAP (includes Big Four firms), Unaffiliated (not subset of BIG 4 and 10KAP), and Other (Blank).
-    """
-    # Define Big Four firms
-    big4 = [
-        '|Deloitte & Touche International|',
-        '|Ernst & Young Global|',
-        '|KPMG International|',
-        '|PricewaterhouseCoopers International|'
-    ]
-
-    # Define 10KAP firms (in addition to Big Four)
-    kap10 = big4 + [
-        '|BDO International|',
-        '|Grant Thornton International|',
-        '|RSM Global (International)|',
-        '|Mazars Worldwide|',
-        '|Nexia International|',
-        '|Baker Tilly International|',
-    ]
-
-    # Assign groups
-    def map_group(name):
-        if name in big4:
-            return 'Big 4'
-        elif name in kap10:
-            return '10KAP'
-        elif name == 'Other (Blank)':
-            return 'Other (Blank)'
-        else:
-            return 'Unaffiliated'
-
-    df['network_group'] = df['auditor_network'].apply(map_group)
+    # A network belongs to the first group that lists it
+    network_groups = {}
+    for group in reversed(taxonomy['groups']):
+        network_groups.update({network: group['name'] for network in group['networks']})
+    network_groups[taxonomy['blank_group']] = taxonomy['blank_group']
+
+    group_names = pd.Index(
+        [group['name'] for group in taxonomy['groups']] + [taxonomy['default_group'], taxonomy['blank_group']]
+    ).unique()
+
+    # Assign groups to the unique network names and take over the codes for all rows
+    networks = df['auditor_network'].astype('category')
+    category_groups = [network_groups.get(network, taxonomy['default_group']) for network in networks.cat.categories]
+    category_codes = np.append(group_names.get_indexer(category_groups), group_names.get_loc(taxonomy['default_group']))
+    df['network_group'] = pd.Categorical.from_codes(category_codes[networks.cat.codes.to_numpy()], categories=group_names)
     return df
 
 if __name__ == "__main__":
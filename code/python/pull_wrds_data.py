@@ -4,27 +4,66 @@
 # This code pulls data from WRDS Audit Analytics Database 
 # ------------------------------------------------------------------------------
 import os
+import json
+import shutil
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
 import dotenv
 
-import pandas as pd
-from utils import read_config, setup_logging
-import wrds
+from utils import read_config, setup_logging, data_path, apply_dtypes, write_data, concat_data_files
+from schema import PULLED_COLUMNS, validate_schema
+from stage_cache import stage_key, restore_outputs, store_outputs
 
 log = setup_logging()
 
+TRANSPARENCY_REPORTS_TABLE = 'audit_europe.feed76_transparency_reports'
+
 def main():
     '''
     Main function to pull data from WRDS.
 
     This function reads the configuration file, gets the WRDS login credentials, and pulls the data from WRDS.
 
-    The data is then saved to a csv file.
+    The data is then saved as csv, parquet or feather file (see `storage_format` in the config).
+    In chunked mode, the data is written to disk chunk by chunk while it is pulled.
+    Several report years or country shards are pulled concurrently and merged afterwards.
     '''
     cfg = read_config('config/pull_data_cfg.yaml')
-    wrds_login = get_wrds_login()
-    wrds_data = pull_wrds_data(cfg, wrds_login)
-    wrds_data.to_csv(cfg['audit_analytics_save_path'], index=False)
+    pull(cfg)
+
+
+def pull(cfg):
+    '''
+    Pulls the data as set in the config and saves it. Returns the pulled data if it was pulled in one piece,
+    or None if it was restored from the stage cache or written to disk chunk by chunk (read it from the save path).
+    '''
+    save_path = data_path(cfg['audit_analytics_save_path'], cfg['storage_format'])
+
+    # The query is only issued again when the query itself (or the data source) changes
+    cache_key = stage_key('pull_wrds_data', {
+        'query': build_query(cfg), 'local_database': cfg.get('local_database'), 'storage_format': cfg['storage_format']
+    })
+    if restore_outputs(cfg.get('stage_cache'), cache_key, [save_path]):
+        return None
+
+    wrds_data = None
+    wrds_login = None if cfg.get('local_database') else get_wrds_login()
+    if len(plan_partitions(cfg)) > 1:
+        pull_wrds_data_parallel(cfg, wrds_login, save_path)
+    elif cfg.get('pull_mode', 'full') == 'chunked':
+        db = connect_database(cfg, wrds_login)
+        pull_wrds_data_chunked(cfg, db, save_path)
+        db.close()
+        log.info("Disconnected from WRDS")
+    else:
+        wrds_data = apply_dtypes(pull_wrds_data(cfg, wrds_login))
+        validate_schema(wrds_data, PULLED_COLUMNS, 'pulled data')
+        write_data(wrds_data, save_path)
+    store_outputs(cfg.get('stage_cache'), cache_key, [save_path])
+    return wrds_data
 
 
 def get_wrds_login():
@@ -42,29 +81,64 @@ def get_wrds_login():
             'Please provide a WRDS password (it will not show as you type): ')
         return {'wrds_username': wrds_username, 'wrds_password': wrds_password}
 
-def pull_wrds_data(cfg, wrds_authentication):
+def connect_database(cfg, wrds_authentication):
     '''
-    Pulls WRDS Audit Europe Transparency Report data.
+    Connects to WRDS, or to the local SQLite stand-in for WRDS if `local_database` is set in the config.
+    The local database is attached as schema `audit_europe`, so the same queries run against both.
     '''
+    if cfg.get('local_database'):
+        db = sqlite3.connect(':memory:', check_same_thread=False)
+        db.execute("ATTACH DATABASE ? AS audit_europe", (cfg['local_database'],))
+        log.info(f"Connected to local database {cfg['local_database']} ...")
+        return db
+    import wrds  # Imports SQLAlchemy and pandas, so only when connecting to WRDS
     db = wrds.Connection(
         wrds_username=wrds_authentication['wrds_username'], wrds_password=wrds_authentication['wrds_password']
     )
-
     log.info('Logged on to WRDS ...')
+    return db
 
+def query_data(db, query):
+    '''
+    Runs a query on a WRDS connection or a DB-API connection and returns a DataFrame with lowercase columns.
+    '''
+    if hasattr(db, 'raw_sql'):
+        df = db.raw_sql(query)
+    else:
+        import pandas as pd
+        df = pd.read_sql(query, db)
+    df.columns = df.columns.str.lower()
+    return df
+
+def build_query(cfg, select=None, extra_filter=None):
+    '''
+    Builds the Transparency Report query for the selected variables, report years and countries.
+    '''
     # Select only the required variables from Transparency Reports
-    selected_vars_str = ', '.join(cfg['selected_vars'])
-    # Apply filter for 2021 and specific countries
+    selected_vars_str = select or ', '.join(cfg['selected_vars'])
+    # Apply filter for the report years and specific countries
+    year_filter = ', '.join([str(int(year)) for year in cfg['report_years']])
     country_filter = ', '.join([f"'{country}'" for country in cfg['included_countries']])
+    filters = [f"REPORT_YEAR IN ({year_filter})", f"TRANS_REPORT_AUDITOR_STATE IN ({country_filter})"]
+    if extra_filter:
+        filters.append(extra_filter)
     query = f"""
         SELECT {selected_vars_str}
-        FROM audit_europe.feed76_transparency_reports
-        WHERE REPORT_YEAR = 2021
-        AND TRANS_REPORT_AUDITOR_STATE IN ({country_filter})
+        FROM {TRANSPARENCY_REPORTS_TABLE}
+        WHERE {' AND '.join(filters)}
     """
+    return query
+
+def pull_wrds_data(cfg, wrds_authentication):
+    '''
+    Pulls WRDS Audit Europe Transparency Report data.
+    '''
+    db = connect_database(cfg, wrds_authentication)
+
+    query = build_query(cfg)
 
     log.info("Pulling Transparency Report data ... ")
-    wrds_data = db.raw_sql(query)
+    wrds_data = query_data(db, query)
     log.info("Pulling Transparency Report data ... Done!")
 
     db.close()
@@ -72,5 +146,164 @@ def pull_wrds_data(cfg, wrds_authentication):
 
     return wrds_data
 
+def plan_chunks(db, cfg):
+    '''
+    Splits the transparency reports matching the query into key ranges of `chunk_size` reports each.
+    Rows without transparency_report_fkey are in no key range, so they get a chunk of their own ([None, None]).
+    '''
+    report_keys = query_data(db, build_query(cfg, select='DISTINCT TRANSPARENCY_REPORT_FKEY'))['transparency_report_fkey']
+    has_blank_keys = report_keys.isna().any()
+    report_keys = report_keys.dropna().astype('int64').sort_values().to_numpy()
+    chunk_size = cfg.get('chunk_size', 1000)
+    chunks = [
+        [int(report_keys[start]), int(report_keys[min(start + chunk_size, len(report_keys)) - 1])]
+        for start in range(0, len(report_keys), chunk_size)
+    ]
+    if has_blank_keys:
+        chunks.append([None, None])
+    return chunks
+
+def chunk_filter(first_key, last_key):
+    '''
+    Filter of the query of a chunk planned by `plan_chunks`.
+    '''
+    if first_key is None:
+        return "TRANSPARENCY_REPORT_FKEY IS NULL"
+    return f"TRANSPARENCY_REPORT_FKEY BETWEEN {first_key} AND {last_key}"
+
+def load_checkpoint(checkpoint_path, query):
+    '''
+    Loads the checkpoint of an interrupted chunked pull, if it was written for the same query.
+    '''
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['query'] == query:
+            return checkpoint
+        log.info("Query changed since the last checkpoint. Starting the pull from scratch.")
+    return None
+
+def save_checkpoint(checkpoint, checkpoint_path):
+    '''
+    Writes the checkpoint atomically, so an interruption never leaves a half-written checkpoint.
+    '''
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, checkpoint_path)
+
+def pull_wrds_data_chunked(cfg, db, save_path):
+    '''
+    Pulls WRDS Audit Europe Transparency Report data in key ranges of `chunk_size` transparency reports.
+
+    Each chunk is written to disk as soon as it arrives and recorded in a checkpoint file,
+    so only one chunk is held in memory and an interrupted pull resumes from the last completed chunk.
+    The chunks are merged into `save_path` at the end.
+    '''
+    chunk_dir = os.path.splitext(save_path)[0] + '_chunks'
+    checkpoint_path = os.path.join(chunk_dir, 'checkpoint.json')
+    extension = os.path.splitext(save_path)[1]
+    query = build_query(cfg)
+
+    checkpoint = load_checkpoint(checkpoint_path, query)
+    if checkpoint is None:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+        os.makedirs(chunk_dir)
+        checkpoint = {'query': query, 'chunks': plan_chunks(db, cfg), 'completed': []}
+        save_checkpoint(checkpoint, checkpoint_path)
+    else:
+        log.info(f"Resuming pull: {len(checkpoint['completed'])} of {len(checkpoint['chunks'])} chunks already completed.")
+
+    chunk_paths = []
+    for i, (first_key, last_key) in enumerate(checkpoint['chunks']):
+        chunk_path = os.path.join(chunk_dir, f'chunk_{i:05d}{extension}')
+        chunk_paths.append(chunk_path)
+        if i in checkpoint['completed']:
+            continue
+        reports = 'without report key' if first_key is None else f'reports {first_key} to {last_key}'
+        log.info(f"Pulling chunk {i + 1} of {len(checkpoint['chunks'])} ({reports}) ...")
+        chunk = query_data(db, build_query(cfg, extra_filter=chunk_filter(first_key, last_key)))
+        write_data(chunk, chunk_path)
+        checkpoint['completed'].append(i)
+        save_checkpoint(checkpoint, checkpoint_path)
+
+    if chunk_paths:
+        concat_data_files(chunk_paths, save_path)
+    else:
+        import pandas as pd
+        write_data(pd.DataFrame(columns=[var.lower() for var in cfg['selected_vars']]), save_path)
+    shutil.rmtree(chunk_dir)
+    log.info(f"Pulling Transparency Report data in {len(chunk_paths)} chunks ... Done!")
+
+def plan_partitions(cfg):
+    '''
+    Splits the pull into one partition per report year and country shard.
+    Each partition is a copy of the config restricted to its year and countries. The partition name
+    includes a hash of the partition's query, so a re-run with other countries, variables or shards
+    never reuses a partition file pulled with a different query.
+    '''
+    n_shards = max(1, min(cfg.get('country_shards', 1), len(cfg['included_countries'])))
+    partitions = []
+    for year in cfg['report_years']:
+        for shard in range(n_shards):
+            partition = {**cfg, 'report_years': [year], 'included_countries': cfg['included_countries'][shard::n_shards]}
+            query_hash = hashlib.sha256(build_query(partition).encode('utf-8')).hexdigest()[:12]
+            partition['partition_name'] = f'{year}_{shard:02d}_{query_hash}'
+            partitions.append(partition)
+    return partitions
+
+def pull_wrds_data_parallel(cfg, wrds_authentication, save_path):
+    '''
+    Pulls the report year and country shard partitions concurrently and merges them into `save_path`.
+
+    The workers share a bounded pool of at most `max_connections` connections (one per worker thread).
+    Every partition is written to its own file first, so a re-run after a failure only pulls
+    the partitions that are still missing.
+    '''
+    partitions = plan_partitions(cfg)
+    partition_dir = os.path.splitext(save_path)[0] + '_partitions'
+    extension = os.path.splitext(save_path)[1]
+    os.makedirs(partition_dir, exist_ok=True)
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def get_connection():
+        if not hasattr(local, 'db'):
+            local.db = connect_database(cfg, wrds_authentication)
+            with lock:
+                connections.append(local.db)
+        return local.db
+
+    def pull_partition(partition_cfg):
+        partition_path = os.path.join(partition_dir, f"{partition_cfg['partition_name']}{extension}")
+        if os.path.exists(partition_path):
+            log.info(f"Partition {partition_cfg['partition_name']} already pulled. Skipping.")
+            return partition_path
+        incomplete_path = os.path.join(partition_dir, f"incomplete_{partition_cfg['partition_name']}{extension}")
+        db = get_connection()
+        if partition_cfg.get('pull_mode', 'full') == 'chunked':
+            pull_wrds_data_chunked(partition_cfg, db, incomplete_path)
+        else:
+            write_data(query_data(db, build_query(partition_cfg)), incomplete_path)
+        os.replace(incomplete_path, partition_path)
+        log.info(f"Pulling partition {partition_cfg['partition_name']} ... Done!")
+        return partition_path
+
+    max_connections = max(1, min(cfg.get('max_connections', 4), len(partitions)))
+    log.info(f"Pulling {len(partitions)} partitions with {max_connections} connections ...")
+    try:
+        with ThreadPoolExecutor(max_workers=max_connections) as executor:
+            partition_paths = list(executor.map(pull_partition, partitions))
+    finally:
+        for db in connections:
+            db.close()
+        log.info("Disconnected from WRDS")
+
+    concat_data_files(partition_paths, save_path)
+    shutil.rmtree(partition_dir)
+    log.info(f"Pulling Transparency Report data in {len(partitions)} partitions ... Done!")
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,283 @@
+# --- Header -------------------------------------------------------------------
+# Local query service: market share and concentration queries on the prepared data,
+# loaded once and answered from in-memory indexes and an LRU result cache
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import json
+from functools import lru_cache
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+from utils import read_config, setup_logging, set_verbosity, data_path, read_data, STEP_METRICS
+from do_analysis import (
+    COUNTRY_KEYS, PANEL_KEYS, build_audit_counts, sum_audit_counts, market_shares_from_counts,
+    calculate_panel_market_shares, calculate_hhi
+)
+
+log = setup_logging()
+
+# Audit counts are kept by country, report year, audit firm and network group. Every key is indexed.
+QUERY_KEYS = ['trans_report_auditor_state', 'report_year', 'auditor_fkey', 'network_group']
+
+# Query filters and the indexed column they select on
+QUERY_FILTERS = {
+    'countries': 'trans_report_auditor_state',
+    'years': 'report_year',
+    'auditors': 'auditor_fkey',
+    'network_groups': 'network_group',
+}
+
+# Filters selecting the market (the denominators of the shares), and filters selecting audit firms within it
+MARKET_FILTERS = ['countries', 'years']
+FIRM_FILTERS = ['auditors', 'network_groups']
+
+# Integer filters, converted when parsed from a URL
+INTEGER_FILTERS = ['years', 'auditors']
+
+def main():
+    '''
+    Loads the prepared data and serves the queries over HTTP until interrupted.
+    '''
+    cfg = read_config('config/query_service_cfg.yaml')
+    analysis_cfg = read_config('config/do_analysis_cfg.yaml')
+    set_verbosity(cfg.get('verbosity', 'WARNING'))
+
+    prepared_data_path = data_path(analysis_cfg['prepared_data_save_path'], analysis_cfg['storage_format'])
+    queries = MarketShareQueries.from_prepared_data(prepared_data_path, cfg['cache_size'])
+    serve(queries, cfg['host'], cfg['port'])
+
+class MarketShareQueries:
+    '''
+    Python API of the service. The prepared data is reduced once to audit counts by QUERY_KEYS, and the row
+    positions of every value of these keys are indexed. Queries select the rows of their filters from the
+    indexes and calculate the shares with the functions of do_analysis.py, so the answers are the same as
+    the pipeline's for the same data. Results are cached per distinct query.
+
+    Filters (all optional, a single value or a list): countries, years, auditors, network_groups.
+    Countries and years select the market, so shares are always in % of all audits of a country (and year).
+    Auditors and network groups only select the firms listed by top_auditors and network_shares.
+    '''
+
+    def __init__(self, counts, cache_size=256):
+        self.counts = counts.reset_index(drop=True)
+        self.index = {
+            column: {value: positions for value, positions in self.counts.groupby(column, observed=True).indices.items()}
+            for column in QUERY_KEYS
+        }
+        self._cached = lru_cache(maxsize=cache_size)(self._evaluate)
+
+    @classmethod
+    def from_prepared_data(cls, prepared_data_path, cache_size=256):
+        '''
+        Loads the prepared data once and builds the indexed audit counts.
+        '''
+        df = read_data(prepared_data_path, columns=QUERY_KEYS + ['audit_weight'])
+        counts = build_audit_counts(df, PANEL_KEYS)
+        log.warning(f"Query service loaded {len(df)} prepared rows into {len(counts)} audit count rows.")
+        return cls(counts, cache_size)
+
+    def market_shares(self, by_year=False, **filters):
+        '''
+        Big 4, 10KAP and CR4 market shares by country and an EU row over the selected countries,
+        as in aggregated_market_shares.csv. The selected report years are pooled, unless `by_year`
+        (shares and HHI per country and report year, as in the panel).
+        '''
+        return self._query('market_shares', by_year, filters)
+
+    def hhi(self, by_year=False, **filters):
+        '''
+        Herfindahl-Hirschman Index by country (and report year if `by_year`).
+        '''
+        return self._query('hhi', by_year, filters)
+
+    def top_auditors(self, n=10, **filters):
+        '''
+        The n audit firms with the most audits in each selected country, with their network group,
+        audit count and market share in %.
+        '''
+        return self._query('top_auditors', n, filters)
+
+    def network_shares(self, **filters):
+        '''
+        Audit count and market share in % of every network group by country.
+        '''
+        return self._query('network_shares', None, filters)
+
+    def cache_info(self):
+        '''
+        Hits, misses and size of the result cache.
+        '''
+        return self._cached.cache_info()
+
+    def _query(self, kind, option, filters):
+        unknown = set(filters) - set(QUERY_FILTERS)
+        if unknown:
+            raise ValueError(f"Unknown query filters: {sorted(unknown)}, use {list(QUERY_FILTERS)}.")
+        firm_filters = [name for name in FIRM_FILTERS if filters.get(name) is not None]
+        if firm_filters and kind in ('market_shares', 'hhi'):
+            raise ValueError(f"The {kind} query covers all audit firms of a market, it cannot be filtered by {firm_filters}.")
+        # Filters are normalized to sorted tuples, so the same query always hits the same cache entry
+        key = tuple(
+            (name, tuple(sorted(normalize_values(filters[name]))))
+            for name in QUERY_FILTERS if filters.get(name) is not None
+        )
+        return self._cached(kind, option, key).copy()
+
+    def select(self, key):
+        '''
+        Returns the audit counts matching the normalized filters, intersecting the indexed row positions.
+        '''
+        positions = None
+        for name, values in key:
+            index = self.index[QUERY_FILTERS[name]]
+            matches = np.concatenate([index.get(value, np.empty(0, dtype=np.intp)) for value in values]) \
+                if values else np.empty(0, dtype=np.intp)
+            positions = matches if positions is None else np.intersect1d(positions, matches)
+        if positions is None:
+            return self.counts
+        return self.counts.take(np.sort(positions))
+
+    def _evaluate(self, kind, option, key):
+        # The shares are calculated over the whole market, the firm filters only select result rows
+        market_key = tuple((name, values) for name, values in key if name in MARKET_FILTERS)
+        firm_key = tuple((name, values) for name, values in key if name in FIRM_FILTERS)
+        counts = self.select(market_key)
+        if counts.empty:
+            raise LookupError(f"No audits match the query {dict(key)}.")
+        try:
+            if kind == 'market_shares':
+                if option:
+                    return calculate_panel_market_shares(sum_audit_counts(counts, PANEL_KEYS))
+                return market_shares_from_counts(sum_audit_counts(counts))
+            if kind == 'hhi':
+                return calculate_hhi(counts, PANEL_KEYS if option else COUNTRY_KEYS)
+            if kind == 'top_auditors':
+                result = top_auditors(counts, option, firm_key)
+            else:
+                result = network_shares(counts, firm_key)
+            if result.empty:
+                raise LookupError(f"No audits match the query {dict(key)}.")
+            return result
+        finally:
+            # The calculation steps record their metrics, which would otherwise pile up in a long-lived process
+            STEP_METRICS.clear()
+
+def normalize_values(values):
+    '''
+    Returns the filter values as a list of scalars, with report years as integers.
+    '''
+    if isinstance(values, (str, int, np.integer)):
+        values = [values]
+    return [int(value) if isinstance(value, np.integer) else value for value in values]
+
+def matching_rows(df, firm_key):
+    '''
+    Returns the rows matching the normalized firm filters.
+    '''
+    mask = np.ones(len(df), dtype=bool)
+    for name, values in firm_key:
+        mask &= df[QUERY_FILTERS[name]].isin(values).to_numpy()
+    return df[mask]
+
+def top_auditors(counts, n, firm_key=()):
+    '''
+    The n audit firms with the most audits by country among the firms matching the firm filters,
+    ranked as in `top_k_audit_counts`. Shares are in % of all audits of the country.
+    '''
+    firm_totals = counts.groupby(COUNTRY_KEYS + ['auditor_fkey', 'network_group'], observed=True)['audit_count'] \
+        .sum().reset_index()
+    firm_totals['market_share'] = firm_totals['audit_count'] / \
+        firm_totals.groupby(COUNTRY_KEYS, observed=True)['audit_count'].transform('sum') * 100
+    ranked = matching_rows(firm_totals, firm_key).sort_values(COUNTRY_KEYS + ['audit_count'], ascending=[True, False])
+    ranked = ranked.groupby(COUNTRY_KEYS, observed=True).head(n).copy()
+    ranked['rank'] = ranked.groupby(COUNTRY_KEYS, observed=True).cumcount() + 1
+    return ranked.reset_index(drop=True)
+
+def network_shares(counts, firm_key=()):
+    '''
+    Audit count and market share in % of every network group by country. With firm filters, only the audits
+    of the matching firms are counted, still in % of all audits of the country.
+    '''
+    group_totals = counts.groupby(COUNTRY_KEYS + ['network_group'], observed=True)['audit_count'].sum().reset_index()
+    country_totals = group_totals.groupby(COUNTRY_KEYS, observed=True)['audit_count'].sum() \
+        .reset_index(name='total_audit_count')
+    if firm_key:
+        group_totals = matching_rows(counts, firm_key) \
+            .groupby(COUNTRY_KEYS + ['network_group'], observed=True)['audit_count'].sum().reset_index()
+    group_totals = group_totals.merge(country_totals, on=COUNTRY_KEYS)
+    group_totals['market_share'] = group_totals['audit_count'] / group_totals['total_audit_count'] * 100
+    return group_totals.drop(columns='total_audit_count')
+
+# Queries answered over HTTP, e.g. GET /market_shares?countries=DE&years=2019,2020,2021
+# or GET /top_auditors?countries=PL&n=10. Responses are JSON lists of records.
+HTTP_QUERIES = {
+    'market_shares': lambda queries, options, filters: queries.market_shares(options.get('by_year') == 'true', **filters),
+    'hhi': lambda queries, options, filters: queries.hhi(options.get('by_year') == 'true', **filters),
+    'top_auditors': lambda queries, options, filters: queries.top_auditors(int(options.get('n', 10)), **filters),
+    'network_shares': lambda queries, options, filters: queries.network_shares(**filters),
+}
+
+def parse_query_string(query_string):
+    '''
+    Splits the URL parameters into filters (comma separated lists, years and auditors as integers) and options.
+    '''
+    params = {name: ','.join(values) for name, values in parse_qs(query_string).items()}
+    filters, options = {}, {}
+    for name, value in params.items():
+        if name in QUERY_FILTERS:
+            values = [v for v in value.split(',') if v]
+            filters[name] = [int(v) for v in values] if name in INTEGER_FILTERS else values
+        else:
+            options[name] = value
+    return filters, options
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    Answers the HTTP_QUERIES from the MarketShareQueries of the server.
+    '''
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.strip('/')
+        if name == 'cache_info':
+            return self.send_json(200, self.server.queries.cache_info()._asdict())
+        if name not in HTTP_QUERIES:
+            return self.send_json(404, {'error': f"Unknown query '{name}', use one of {list(HTTP_QUERIES)}."})
+        try:
+            filters, options = parse_query_string(url.query)
+            result = HTTP_QUERIES[name](self.server.queries, options, filters)
+        except LookupError as e:
+            return self.send_json(404, {'error': str(e)})
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(200, json.loads(result.to_json(orient='records')))
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        log.info(f"{self.address_string()} {format % args}")
+
+def serve(queries, host='127.0.0.1', port=8050):
+    '''
+    Serves the queries over HTTP on host:port. Requests are answered one at a time.
+    '''
+    server = HTTPServer((host, port), QueryHandler)
+    server.queries = queries
+    log.warning(f"Query service listening on http://{host}:{port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
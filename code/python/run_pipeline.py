@@ -0,0 +1,125 @@
+# --- Header -------------------------------------------------------------------
+# Run the pipeline (pull, prepare, analyse, export and plot) in one process as a DAG of stages.
+# DataFrames are handed between the stages in memory, and independent stages run concurrently.
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import read_config, setup_logging, set_verbosity, track_step, write_metrics
+import pull_wrds_data
+import prepare_data
+import do_analysis
+
+log = setup_logging()
+
+def run_pull(cfgs, inputs):
+    '''
+    Pulls the data. The pulled data is always saved, as the pull is cached by its query.
+    '''
+    return pull_wrds_data.pull(cfgs['pull'])
+
+def run_prepare(cfgs, inputs):
+    '''
+    Prepares the pulled data, saving it only if it is a declared output.
+    '''
+    return prepare_data.prepare(cfgs['prepare'], inputs['pull'], cfgs['pipeline'].get('save_prepared_data', True))
+
+def run_analyse(cfgs, inputs):
+    return do_analysis.analyse(cfgs['analysis'], inputs['prepare'])
+
+def run_export(cfgs, inputs):
+    do_analysis.save_results(cfgs['analysis'], inputs['analyse'])
+
+def run_plot(cfgs, inputs):
+    cfg = cfgs['analysis']
+    do_analysis.plot_market_shares(
+        inputs['analyse']['market_shares'], cfg['figure_save_path'], cfg['plot_data_save_path'], cfg['countries_order']
+    )
+
+# The stages, the stages they need the results of, and the function running them with these results
+STAGES = {
+    'pull': {'requires': [], 'run': run_pull},
+    'prepare': {'requires': ['pull'], 'run': run_prepare},
+    'analyse': {'requires': ['prepare'], 'run': run_analyse},
+    'export': {'requires': ['analyse'], 'run': run_export},
+    'plot': {'requires': ['analyse'], 'run': run_plot},
+}
+
+def main():
+    '''
+    Runs the stages needed for the targets of the pipeline config, reading every config once.
+    '''
+    log.info("Running the pipeline ...")
+    cfg = read_config('config/pipeline_cfg.yaml')
+    set_verbosity(cfg.get('verbosity', 'INFO'))
+    cfgs = {
+        'pipeline': cfg,
+        'pull': read_config('config/pull_data_cfg.yaml'),
+        'prepare': read_config('config/prepare_data_cfg.yaml'),
+        'analysis': read_config('config/do_analysis_cfg.yaml'),
+    }
+    run_stages(STAGES, cfg['targets'], cfgs, cfg.get('workers', 2))
+    write_metrics(cfg['metrics_save_path'])
+    log.info("Running the pipeline ... Done!")
+
+def required_stages(stages, targets):
+    '''
+    Returns the targets and all stages they depend on, in an order where every stage follows its requirements.
+    '''
+    ordered = []
+
+    def visit(name, path):
+        if name not in stages:
+            raise ValueError(f"Unknown pipeline stage '{name}', use one of {list(stages)}.")
+        if name in path:
+            raise ValueError(f"Pipeline stages depend on each other in a cycle: {' -> '.join(path + [name])}")
+        if name in ordered:
+            return
+        for requirement in stages[name]['requires']:
+            visit(requirement, path + [name])
+        ordered.append(name)
+
+    for target in targets:
+        visit(target, [])
+    return ordered
+
+def run_stages(stages, targets, cfgs, workers=2):
+    '''
+    Runs the stages needed for the targets over a pool of `workers` threads. A stage starts as soon as the
+    stages it requires are done and gets their results in memory. Results are dropped once no pending
+    stage needs them. The first failing stage stops the pipeline.
+    '''
+    pending = required_stages(stages, targets)
+    results, running = {}, {}
+    log.info(f"Pipeline stages: {', '.join(pending)}")
+
+    def run(name):
+        with track_step(f"stage_{name}"):
+            return stages[name]['run'](cfgs, {requirement: results[requirement] for requirement in stages[name]['requires']})
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            for name in [name for name in pending if all(r in results for r in stages[name]['requires'])]:
+                pending.remove(name)
+                running[executor.submit(run, name)] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    log.error(f"Pipeline stage '{name}' failed.")
+                    for other in running:
+                        other.cancel()
+                    raise
+                log.info(f"Pipeline stage '{name}' done.")
+
+            # Release the results no pending or running stage needs any more
+            needed = {r for stage in pending + list(running.values()) for r in stages[stage]['requires']}
+            for finished in [finished for finished in results if finished not in needed and finished not in targets]:
+                results[finished] = None
+    return results
+
+if __name__ == '__main__':
+    main()
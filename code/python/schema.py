@@ -0,0 +1,103 @@
+# --- Header -------------------------------------------------------------------
+# Schema of the transparency report data handed between the stages
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+
+# Dtypes of the columns in selected_vars (pull_data_cfg.yaml) and of the columns added by the preparation.
+# Keys are nullable integers downcast to the smallest type holding Audit Analytics' identifiers, so blanks
+# never promote them to float. Country and network names are categoricals (dictionary-encoded).
+SCHEMA = {
+    'transparency_report_fkey': 'Int32',
+    'entity_map_fkey': 'Int32',
+    'auditor_fkey': 'Int32',
+    'trans_report_auditor_state': 'category',
+    'auditor_network': 'category',
+    'report_year': 'Int16',
+    'number_of_disclosed_pies': 'Int32',
+    'network_group': 'category',
+    'audit_weight': 'float64',
+}
+
+# Columns of the pulled data (selected_vars) and of the prepared data
+PULLED_COLUMNS = [
+    'transparency_report_fkey', 'entity_map_fkey', 'auditor_fkey', 'trans_report_auditor_state',
+    'auditor_network', 'report_year', 'number_of_disclosed_pies'
+]
+PREPARED_COLUMNS = PULLED_COLUMNS + ['network_group', 'audit_weight']
+
+def schema_dtypes(columns=None):
+    '''
+    Returns the declared dtypes of the given columns (all declared columns if `columns` is None).
+    '''
+    return {col: dtype for col, dtype in SCHEMA.items() if columns is None or col in columns}
+
+def apply_schema(df):
+    '''
+    Casts the declared columns of a DataFrame to their schema dtypes. Columns already
+    in their dtype are left as they are. Categorical columns get sorted categories without
+    unused ones, whatever file format, chunk or step they come from, so grouped results
+    are in the same (alphabetical) order everywhere.
+    '''
+    dtypes = {col: dtype for col, dtype in schema_dtypes(df.columns).items() if df[col].dtype != dtype}
+    for col, dtype in dtypes.items():
+        try:
+            df = df.astype({col: dtype})
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Column '{col}' does not fit the schema dtype {dtype}: {e}") from e
+    for col, dtype in schema_dtypes(df.columns).items():
+        if dtype == 'category' and not has_sorted_categories(df[col]):
+            # A shallow copy, so the caller's DataFrame keeps its column
+            df = df.copy(deep=False)
+            df[col] = sort_categories(df[col])
+    return df
+
+def used_categories(series):
+    '''
+    Returns a boolean array marking the categories of a categorical series that occur in it.
+    '''
+    import numpy as np
+    codes = series.cat.codes.to_numpy()
+    return np.bincount(codes[codes >= 0], minlength=len(series.cat.categories)) > 0
+
+def has_sorted_categories(series):
+    '''
+    Checks that the categories of a categorical series are sorted and all occur in it.
+    '''
+    return series.cat.categories.is_monotonic_increasing and used_categories(series).all()
+
+def sort_categories(series):
+    '''
+    Returns a categorical series with sorted categories, dropping the categories that do not occur.
+    Only the codes are remapped, the values stay the same.
+    '''
+    import numpy as np
+    import pandas as pd
+    categories = series.cat.categories
+    new_categories = categories[used_categories(series)].sort_values()
+    category_codes = new_categories.get_indexer(categories)
+    codes = series.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, category_codes[codes], -1)
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories=new_categories),
+        index=series.index, name=series.name
+    )
+
+def validate_schema(df, columns, stage):
+    '''
+    Checks that a DataFrame handed on between stages has the given columns, and that every declared
+    column has its schema dtype. Raises a ValueError listing all deviations.
+    '''
+    problems = [f"missing column '{col}'" for col in columns if col not in df.columns]
+    problems += [
+        f"column '{col}' is {df[col].dtype}, expected {dtype}"
+        for col, dtype in schema_dtypes(df.columns).items() if df[col].dtype != dtype
+    ]
+    if problems:
+        raise ValueError(f"Data does not match the schema at {stage}: {'; '.join(problems)}")
+
+def memory_usage_mb(df):
+    '''
+    Returns the memory used by a DataFrame in MB, including the strings of object columns.
+    '''
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
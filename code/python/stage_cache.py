@@ -0,0 +1,118 @@
+# --- Header -------------------------------------------------------------------
+# Content-addressed cache for the pipeline stages
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import os
+import json
+import shutil
+import hashlib
+from utils import setup_logging
+
+log = setup_logging()
+
+FINGERPRINTS_FILE = 'fingerprints.json'
+
+def file_fingerprint(path, cache_dir=None):
+    '''
+    Returns the sha256 hash of a file's content. If `cache_dir` is given, hashes are memoized
+    by path, size and modification time, so unchanged files are not read again.
+    '''
+    stat = os.stat(path)
+    memo_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    memo_path = os.path.join(cache_dir, FINGERPRINTS_FILE) if cache_dir else None
+    memo = {}
+    if memo_path and os.path.exists(memo_path):
+        with open(memo_path, 'r') as f:
+            memo = json.load(f)
+        if memo_key in memo:
+            return memo[memo_key]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    fingerprint = sha.hexdigest()
+
+    if memo_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        memo = {k: v for k, v in memo.items() if not k.startswith(os.path.abspath(path) + ':')}
+        memo[memo_key] = fingerprint
+        with open(memo_path, 'w') as f:
+            json.dump(memo, f)
+    return fingerprint
+
+def stage_key(stage, cfg, input_paths=(), code_paths=(), cache_dir=None):
+    '''
+    Returns the cache key of a stage run: a hash of the stage name, its effective config,
+    the fingerprints of its input data and the source code of the stage.
+    '''
+    sha = hashlib.sha256(stage.encode())
+    effective_cfg = {k: v for k, v in cfg.items() if k != 'stage_cache'}
+    sha.update(json.dumps(effective_cfg, sort_keys=True, default=str).encode())
+    for path in input_paths:
+        sha.update(file_fingerprint(path, cache_dir).encode())
+    for path in code_paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def restore_outputs(cache_cfg, key, output_paths):
+    '''
+    Copies the cached outputs of `key` to `output_paths`. Returns False if the cache is
+    disabled or has no complete entry for the key.
+    '''
+    if not cache_cfg or not cache_cfg.get('enabled', False):
+        return False
+    entry_dir = os.path.join(cache_cfg['cache_dir'], key)
+    cached_paths = [os.path.join(entry_dir, f'{i}_{os.path.basename(path)}') for i, path in enumerate(output_paths)]
+    if not all(os.path.exists(path) for path in cached_paths):
+        return False
+    for cached_path, output_path in zip(cached_paths, output_paths):
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        # Not copy2: restored outputs get the current mtime, so make sees them as newer than their inputs
+        shutil.copy(cached_path, output_path)
+    os.utime(entry_dir)  # Mark the entry as recently used
+    log.info(f"Stage cache hit ({key[:12]}): restored {len(output_paths)} outputs.")
+    return True
+
+def store_outputs(cache_cfg, key, output_paths):
+    '''
+    Stores the outputs of a stage run under `key` and evicts the least recently used
+    entries once the cache exceeds `max_size_mb`.
+    '''
+    if not cache_cfg or not cache_cfg.get('enabled', False):
+        return
+    cache_dir = cache_cfg['cache_dir']
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = f'{entry_dir}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for i, path in enumerate(output_paths):
+        shutil.copy2(path, os.path.join(tmp_dir, f'{i}_{os.path.basename(path)}'))
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.replace(tmp_dir, entry_dir)
+    log.info(f"Stage outputs stored in cache ({key[:12]}).")
+    evict_entries(cache_dir, cache_cfg.get('max_size_mb', 2048) * 1024 ** 2)
+
+def entry_size(entry_dir):
+    '''
+    Returns the total size of the files in a cache entry in bytes.
+    '''
+    return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+def evict_entries(cache_dir, max_bytes):
+    '''
+    Removes the least recently used cache entries until the cache is at most `max_bytes` large.
+    '''
+    entries = [
+        os.path.join(cache_dir, name) for name in os.listdir(cache_dir)
+        if os.path.isdir(os.path.join(cache_dir, name)) and '.tmp' not in name
+    ]
+    entries.sort(key=os.path.getmtime)
+    total_size = sum(entry_size(entry) for entry in entries)
+    while entries and total_size > max_bytes:
+        entry = entries.pop(0)
+        total_size -= entry_size(entry)
+        shutil.rmtree(entry)
+        log.info(f"Evicted stage cache entry {os.path.basename(entry)[:12]}.")
@@ -0,0 +1,106 @@
+# --- Header -------------------------------------------------------------------
+# Benchmark the cold start of the command line: every command runs in fresh interpreters
+# and has to start within the budget of config/benchmark_cfg.yaml
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import os
+import sys
+import json
+import time
+import shlex
+import platform
+import subprocess
+from datetime import datetime
+
+from utils import read_config, setup_logging
+
+log = setup_logging()
+
+def main():
+    '''
+    Times the commands and modules of the startup config, saves the results as JSON and
+    returns 1 if a command is over budget (so schedulers and CI can fail on it).
+    '''
+    cfg = read_config('config/benchmark_cfg.yaml')
+    startup = cfg['startup']
+    budget, repeats, slowest = startup['budget_seconds'], startup['repeats'], startup.get('slowest_imports', 10)
+
+    results = [{'kind': 'interpreter', 'name': 'python -c pass', 'seconds': time_run(['-c', 'pass'], repeats)}]
+    for command in startup['commands']:
+        seconds = time_run(shlex.split(command), repeats)
+        over_budget = seconds > budget
+        results.append({'kind': 'command', 'name': command, 'seconds': seconds, 'over_budget': over_budget})
+        if over_budget:
+            log.warning(f"'{command}' starts in {seconds:.3f}s, over the budget of {budget}s. Slowest imports:")
+            log_slowest_imports(shlex.split(command), slowest)
+        else:
+            log.info(f"'{command}' starts in {seconds:.3f}s (budget {budget}s).")
+    for module in startup.get('modules', []):
+        seconds = time_run(['-c', f'import {module}'], repeats)
+        results.append({'kind': 'module', 'name': module, 'seconds': seconds})
+        log.info(f"import {module}: {seconds:.3f}s. Slowest imports:")
+        log_slowest_imports(['-c', f'import {module}'], slowest)
+
+    save_results(results, cfg['results_dir'], budget, repeats)
+    return int(any(result.get('over_budget') for result in results))
+
+def python_env():
+    '''
+    Environment of the timed interpreters: the project modules are importable, as when running a script.
+    '''
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.join('code', 'python'), env.get('PYTHONPATH')]))
+    return env
+
+def time_run(args, repeats):
+    '''
+    Runs `python <args>` `repeats` times in a fresh interpreter and returns the fastest wall time in seconds.
+    '''
+    best_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, env=python_env(), capture_output=True, check=True)
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+    return round(best_seconds, 6)
+
+def slowest_imports(args, n=10):
+    '''
+    Returns the n imports with the largest cumulative import time (seconds) of `python <args>`,
+    from the `-X importtime` report of the interpreter.
+    '''
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + args, env=python_env(), capture_output=True, text=True
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(imports, key=lambda entry: entry[1], reverse=True)[:n]
+
+def log_slowest_imports(args, n):
+    for name, seconds in slowest_imports(args, n):
+        log.info(f"    {name}: {seconds:.3f}s")
+
+def save_results(results, results_dir, budget, repeats):
+    '''
+    Saves the startup timings with the Python version as JSON next to the step benchmarks.
+    '''
+    os.makedirs(results_dir, exist_ok=True)
+    created = datetime.now()
+    save_path = os.path.join(results_dir, f"startup_{created:%Y%m%d_%H%M%S}.json")
+    with open(save_path, 'w') as f:
+        json.dump({
+            'created': created.isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'budget_seconds': budget,
+            'repeats': repeats,
+            'results': results,
+        }, f, indent=2)
+    log.info(f"Startup benchmark results saved to {save_path}.")
+    return save_path
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+# --- Header -------------------------------------------------------------------
+# Sensitivity sweep of the market shares over the methodology assumptions
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from utils import read_config, setup_logging, set_verbosity, data_path, read_data, fill_missing, instrument
+from prepare_data import (
+    PULLED_COLUMNS, validate_transparency_data, standardize_greece_abbreviation, standardize_auditor_network_names,
+    map_auditor_networks, count_joint_auditors, joint_audit_weights
+)
+from do_analysis import sum_audit_counts, market_shares_from_counts, save_market_shares
+
+log = setup_logging()
+
+# The assumptions that change the intermediate aggregate come first, so their scenarios are adjacent in the grid
+ASSUMPTIONS = ['count_measure', 'joint_audits', 'blank_networks', 'network_aliases', 'greece']
+SWEEP_METRICS = ['big4_market_share', 'kap10_market_share', 'cr4_market_share']
+
+# Base data and settings of a worker process, set once by the pool initializer
+_worker_base = None
+
+def main():
+    '''
+    Evaluates the market shares for every combination of the assumptions in the config
+    and saves them as a tidy table, with the difference to the baseline scenario.
+    '''
+    log.info("Sweeping the methodology assumptions ...")
+    cfg = read_config('config/sweep_cfg.yaml')
+    prepare_cfg = read_config('config/prepare_data_cfg.yaml')
+    set_verbosity(cfg.get('verbosity', 'INFO'))
+
+    # The scenarios start from the pulled data, so that every step the assumptions change can be varied
+    pulled_data_path = data_path(prepare_cfg['audit_analytics_save_path'], prepare_cfg['storage_format'])
+    base = prepare_base_data(read_data(pulled_data_path, columns=PULLED_COLUMNS), prepare_cfg['network_taxonomy'])
+
+    sweep = sweep_assumptions(base, cfg['assumptions'], prepare_cfg['network_taxonomy'], cfg.get('workers'))
+    sweep = compare_with_baseline(sweep, cfg['baseline'])
+    save_market_shares(sweep, cfg['sweep_save_path'])
+    log.info("Sweeping the methodology assumptions ... Done!")
+
+@instrument(filter_step=True)
+def prepare_base_data(df, taxonomy):
+    '''
+    Applies the preparation steps that are the same in every scenario (the validation rules, which drop blank
+    vital fields and reports without disclosed PIEs). Country and network names are kept as reported.
+    '''
+    return validate_transparency_data(df, taxonomy)
+
+def scenario_grid(assumptions):
+    '''
+    Returns every combination of the assumption values as a list of dicts.
+    '''
+    return [dict(zip(ASSUMPTIONS, values)) for values in itertools.product(*(assumptions[a] for a in ASSUMPTIONS))]
+
+def audit_weights(df, count_measure, joint_audits):
+    '''
+    Returns the number of audits every row counts for.
+
+    count_measure: 'rows' counts one audit per listed entity, 'disclosed_pies' spreads the
+    number_of_disclosed_pies of a report evenly over its rows.
+    joint_audits: the joint audit rule of `joint_audit_weights`.
+    '''
+    weights = pd.Series(1.0, index=df.index)
+    if count_measure == 'disclosed_pies':
+        report_rows = df.groupby('transparency_report_fkey')['transparency_report_fkey'].transform('size')
+        weights = df['number_of_disclosed_pies'].astype('float64') / report_rows
+    elif count_measure != 'rows':
+        raise ValueError(f"Unknown count_measure '{count_measure}'.")
+    return weights * joint_audit_weights(count_joint_auditors(df), joint_audits)
+
+def weighted_counts(df, count_measure, joint_audits):
+    '''
+    Sums the audit weights per reported country, audit firm and reported network. This is the
+    intermediate aggregate shared by all scenarios with the same count measure and joint audit rule.
+    '''
+    return (
+        df.assign(audit_count=audit_weights(df, count_measure, joint_audits))
+        .groupby(['trans_report_auditor_state', 'auditor_fkey', 'auditor_network'],
+                 dropna=False, observed=True, sort=False)['audit_count']
+        .sum()
+        .reset_index()
+    )
+
+def scenario_market_shares(counts, scenario, taxonomy):
+    '''
+    Calculates the market shares of one scenario from the intermediate aggregate. The country and network
+    assumptions only rename or drop categories, so they work on the aggregate instead of the rows.
+    '''
+    counts = counts.copy()
+    if scenario['blank_networks'] == 'exclude':
+        counts = counts[counts['auditor_network'].notna()]
+    if scenario['greece'] == 'EL':
+        counts = standardize_greece_abbreviation(counts)
+
+    counts['auditor_network'] = fill_missing(counts['auditor_network'], taxonomy['blank_group'])
+    if scenario['network_aliases'] == 'merge':
+        counts = standardize_auditor_network_names(counts, taxonomy['aliases'])
+    counts = map_auditor_networks(counts, taxonomy)
+
+    market_shares = market_shares_from_counts(sum_audit_counts(counts))
+    return market_shares.melt(
+        id_vars='trans_report_auditor_state', value_vars=SWEEP_METRICS, var_name='metric', value_name='market_share'
+    ).assign(**scenario)
+
+def init_worker(base, taxonomy):
+    '''
+    Keeps the base data in the worker process for all its tasks, with the logging of the
+    analysis steps reduced to warnings.
+    '''
+    global _worker_base
+    _worker_base = (base, taxonomy)
+    set_verbosity('WARNING')
+
+def evaluate_scenarios(scenarios):
+    '''
+    Builds the intermediate aggregate once and evaluates all scenarios that share it
+    (the same count measure and joint audit rule).
+    '''
+    base, taxonomy = _worker_base
+    counts = weighted_counts(base, scenarios[0]['count_measure'], scenarios[0]['joint_audits'])
+    return pd.concat([scenario_market_shares(counts, scenario, taxonomy) for scenario in scenarios], ignore_index=True)
+
+@instrument
+def sweep_assumptions(base, assumptions, taxonomy, workers=None):
+    '''
+    Evaluates all combinations of the assumptions over a pool of `workers` processes. Scenarios are
+    grouped by the intermediate aggregate they share, and every group is one task.
+    '''
+    scenarios = scenario_grid(assumptions)
+    tasks = [
+        list(group) for _, group in itertools.groupby(
+            scenarios, key=lambda scenario: (scenario['count_measure'], scenario['joint_audits'])
+        )
+    ]
+    log.info(f"Evaluating {len(scenarios)} scenarios in {len(tasks)} groups ...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(base, taxonomy)) as executor:
+        sweep = pd.concat(list(executor.map(evaluate_scenarios, tasks)), ignore_index=True)
+    return sweep[ASSUMPTIONS + ['trans_report_auditor_state', 'metric', 'market_share']]
+
+def compare_with_baseline(sweep, baseline):
+    '''
+    Adds the market share of the baseline scenario and the difference to it
+    for every country and metric. Greece is joined as 'EL', so scenarios keeping the pulled 'GR'
+    abbreviation are compared with the baseline's Greek shares.
+    '''
+    is_baseline = (sweep[list(baseline)] == pd.Series(baseline)).all(axis=1)
+    sweep = sweep.assign(country_key=sweep['trans_report_auditor_state'].replace({'GR': 'EL'}))
+    baseline_shares = sweep.loc[is_baseline, ['country_key', 'metric', 'market_share']]
+    sweep = sweep.merge(
+        baseline_shares.rename(columns={'market_share': 'baseline_market_share'}),
+        on=['country_key', 'metric'], how='left'
+    ).drop(columns='country_key')
+    sweep['difference'] = sweep['market_share'] - sweep['baseline_market_share']
+    return sweep
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# --- Header -------------------------------------------------------------------
+# Generate synthetic Audit Analytics transparency report data
+# (shaped like audit_europe.feed76_transparency_reports) for benchmarks without WRDS access
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import numpy as np
+import pandas as pd
+from utils import apply_dtypes
+
+COUNTRIES = [
+    'DK', 'CY', 'FI', 'SE', 'LU', 'BE', 'EE', 'AT', 'NO', 'NL', 'IT', 'ES', 'IE', 'DE',
+    'MT', 'LT', 'HU', 'LV', 'CZ', 'HR', 'SI', 'SK', 'FR', 'PL', 'PT', 'GR', 'RO', 'BG'
+]
+
+# Network names with their share of audit firms. Includes the duplicate spellings found in the data.
+NETWORKS = {
+    '|Deloitte & Touche International|': 0.05,
+    '|Ernst & Young Global|': 0.05,
+    '|KPMG International|': 0.05,
+    '|PricewaterhouseCoopers International|': 0.05,
+    '|BDO International|': 0.04,
+    '|Grant Thornton International|': 0.04,
+    '|RSM Global (International)|': 0.03,
+    '|Mazars Worldwide|': 0.03,
+    '|Mazars Worldwide|Praxity Global Alliance|': 0.01,
+    '|Nexia International|': 0.03,
+    '|Baker Tilly International|': 0.03,
+    '|Praxity Global Alliance|TALENZ International|': 0.01,
+    '|Morison KSi|': 0.01,
+    '|Morison International|': 0.01,
+    '|Crowe Global|': 0.04,
+    '|HLB International|': 0.03,
+    '|Kreston Global|': 0.03,
+    '|PKF International|': 0.03,
+}
+BIG4_NETWORKS = list(NETWORKS)[:4]
+
+def generate_transparency_reports(n_rows, n_countries=len(COUNTRIES), n_auditors=None, n_networks=len(NETWORKS),
+                                  report_years=(2021,), joint_audit_rate=0.05, missing_network_rate=0.2,
+                                  missing_value_rate=0.001, pie_mismatch_rate=0.1, seed=0):
+    """
+    Generate a synthetic transparency report dataset with `n_rows` (entity, report) rows.
+
+    Audit firms are spread over `n_countries` countries and `n_networks` networks, a share of
+    `missing_network_rate` firms has no network. Big 4 firms audit most entities.
+    Each firm files one transparency report per report year. A share of `joint_audit_rate` entities is listed
+    in a second report of the same country and year, a share of `pie_mismatch_rate` reports discloses a
+    different number of PIEs than it lists, and vital fields are blank with rate `missing_value_rate`.
+    """
+    rng = np.random.default_rng(seed)
+    countries = np.array(COUNTRIES[:n_countries])
+    networks = list(NETWORKS)[:n_networks]
+    n_auditors = n_auditors or max(4 * len(countries), min(n_rows // 20, 20000))
+
+    # Audit firms with their country, network and size (Big 4 firms are much larger)
+    network_shares = np.array([NETWORKS[network] for network in networks])
+    network_probs = np.append(network_shares / network_shares.sum() * (1 - missing_network_rate), missing_network_rate)
+    auditor_networks = np.array(networks + [None], dtype=object)[
+        rng.choice(len(networks) + 1, size=n_auditors, p=network_probs)
+    ]
+    auditor_countries = rng.choice(countries, size=n_auditors, p=rng.dirichlet(np.full(len(countries), 2.0)))
+    auditor_sizes = rng.pareto(1.5, size=n_auditors) + 1
+    auditor_sizes[np.isin(auditor_networks, BIG4_NETWORKS)] *= 25
+    auditor_fkeys = rng.choice(np.arange(1000, 1000 + 50 * n_auditors), size=n_auditors, replace=False)
+
+    # One transparency report per audit firm and report year
+    report_auditors = np.tile(np.arange(n_auditors), len(report_years))
+    report_years_arr = np.repeat(np.asarray(report_years), n_auditors)
+    n_reports = len(report_auditors)
+    report_probs = auditor_sizes[report_auditors] / auditor_sizes[report_auditors].sum()
+
+    # Assign rows to reports, sorted by country and year
+    row_reports = rng.choice(n_reports, size=n_rows, p=report_probs)
+    _, row_countries = np.unique(auditor_countries[report_auditors[row_reports]], return_inverse=True)
+    row_markets = row_countries * len(report_years) + np.searchsorted(np.sort(report_years), report_years_arr[row_reports])
+    order = np.lexsort((row_reports, row_markets))
+    row_reports, row_markets = row_reports[order], row_markets[order]
+    row_auditors = report_auditors[row_reports]
+
+    # Entities are unique per row, except for joint audits that repeat an entity of the same country and year
+    entity_map_fkeys = rng.permutation(n_rows).astype('float64') + 1
+    joint = np.flatnonzero(rng.random(n_rows) < joint_audit_rate)
+    market_starts = np.searchsorted(row_markets, row_markets[joint], side='left')
+    market_ends = np.searchsorted(row_markets, row_markets[joint], side='right')
+    partners = market_starts + (rng.random(len(joint)) * (market_ends - market_starts)).astype('int64')
+    entity_map_fkeys[partners] = entity_map_fkeys[joint]
+
+    df = pd.DataFrame({
+        'transparency_report_fkey': row_reports + 1,
+        'entity_map_fkey': entity_map_fkeys,
+        'auditor_fkey': auditor_fkeys[row_auditors].astype('float64'),
+        'trans_report_auditor_state': auditor_countries[row_auditors].astype(object),
+        'auditor_network': auditor_networks[row_auditors],
+        'report_year': report_years_arr[row_reports],
+    })
+
+    # Number of disclosed PIEs, deviating from the listed entities for some reports
+    listed = df.groupby('transparency_report_fkey')['entity_map_fkey'].transform('nunique').to_numpy()
+    report_deviation = np.where(rng.random(n_reports) < pie_mismatch_rate, rng.integers(-3, 4, size=n_reports), 0)
+    df['number_of_disclosed_pies'] = np.clip(listed + report_deviation[row_reports], 0, None)
+
+    # Blank values in the vital fields
+    for field in ['entity_map_fkey', 'auditor_fkey', 'trans_report_auditor_state']:
+        df.loc[rng.random(n_rows) < missing_value_rate, field] = None
+
+    return apply_dtypes(df)
+
+if __name__ == '__main__':
+    print(generate_transparency_reports(10000).describe(include='all'))
@@ -1,6 +1,18 @@
 import os
+import sys
+import socket
+import argparse
 import dotenv
-import wrds
+
+# WRDS PostgreSQL server the wrds package connects to
+WRDS_HOST = 'wrds-pgdata.wharton.upenn.edu'
+WRDS_PORT = 9737
+WRDS_DBNAME = 'wrds'
+
+# Connection checks, from cheapest to complete: 'reachable' only opens a TCP connection to the server,
+# 'login' logs in with the credentials and runs `SELECT 1`, 'full' connects with the wrds package
+# as pull_wrds_data.py does (imports SQLAlchemy and pandas)
+CHECK_MODES = ['reachable', 'login', 'full']
 
 def load_wrds_credentials():
     '''
@@ -14,10 +26,37 @@ def load_wrds_credentials():
     else:
         raise FileNotFoundError("secrets.env file not found")
 
+def check_reachable(timeout=5):
+    '''
+    Check that the WRDS server accepts connections, without credentials.
+    '''
+    with socket.create_connection((WRDS_HOST, WRDS_PORT), timeout=timeout):
+        pass
+    print(f"WRDS server {WRDS_HOST}:{WRDS_PORT} is reachable.")
+
+def check_login(timeout=5):
+    '''
+    Check that the credentials from secrets.env log in to WRDS, with a plain database connection.
+    '''
+    import psycopg2
+    credentials = load_wrds_credentials()
+    conn = psycopg2.connect(
+        host=WRDS_HOST, port=WRDS_PORT, dbname=WRDS_DBNAME, sslmode='require', connect_timeout=timeout,
+        user=credentials['wrds_username'], password=credentials['wrds_password']
+    )
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+    finally:
+        conn.close()
+    print("Login to WRDS successful!")
+
 def test_wrds_connection():
     '''
     Test WRDS connection with credentials from secrets.env.
     '''
+    import wrds
     credentials = load_wrds_credentials()
     db = wrds.Connection(
         wrds_username=credentials['wrds_username'],
@@ -26,8 +65,29 @@ def test_wrds_connection():
     print("Connection to WRDS successful!")
     db.close()
 
-if __name__ == '__main__':
+def check_connection(mode='full', timeout=5):
+    '''
+    Run the connection check of the given mode. Returns the exit code: 0 on success, 1 on failure.
+    '''
     try:
-        test_wrds_connection()
+        if mode == 'reachable':
+            check_reachable(timeout)
+        elif mode == 'login':
+            check_login(timeout)
+        else:
+            test_wrds_connection()
     except Exception as e:
-        print(f"Error connecting to WRDS: {e}")
\ No newline at end of file
+        print(f"Error connecting to WRDS: {e}")
+        return 1
+    return 0
+
+def add_arguments(parser):
+    parser.add_argument('--mode', choices=CHECK_MODES, default='full',
+                        help="reachable: server accepts connections, login: credentials work, full: wrds connection (default)")
+    parser.add_argument('--timeout', type=float, default=5, help="seconds to wait for the server (reachable and login)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check the connection to WRDS.")
+    add_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(check_connection(args.mode, args.timeout))
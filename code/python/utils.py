@@ -1,5 +1,21 @@
 import logging
+import os
+import json
+import time
+import shutil
+import platform
+import functools
+from contextlib import contextmanager
 import yaml
+from schema import schema_dtypes, apply_schema
+
+# pandas, numpy and pyarrow are imported in the functions using them, so that entry points
+# without data (e.g. `cli.py --help` or the connection check) start without loading them
+
+STORAGE_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+# Metrics recorded by `track_step` and `instrument` in this process
+STEP_METRICS = []
 
 def read_config(config_file):
     '''
@@ -18,4 +34,308 @@ def setup_logging():
         handlers=[logging.StreamHandler()],
     )
     log = logging.getLogger(__name__)
-    return log
\ No newline at end of file
+    return log
+
+
+def set_verbosity(level):
+    '''
+    Sets the log level ('DEBUG', 'INFO', 'WARNING', ...) of the pipeline logger.
+    Intermediate results are only formatted and logged at 'DEBUG'.
+    '''
+    logging.getLogger(__name__).setLevel(level)
+
+
+def log_frame(title, df, rows=5):
+    '''
+    Logs the first rows of a DataFrame at DEBUG level. The frame is only formatted if DEBUG is enabled.
+    '''
+    log = logging.getLogger(__name__)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(f"{title}\n{df.head(rows) if rows else df}")
+
+
+def current_rss():
+    '''
+    Returns the resident set size of this process in bytes (Linux), or its peak RSS on other systems.
+    '''
+    if os.path.exists('/proc/self/statm'):
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return peak_rss()
+
+
+def peak_rss():
+    '''
+    Returns the peak resident set size of this process in bytes.
+    '''
+    import resource
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+@contextmanager
+def track_step(step, rows_in=None, filter_step=False):
+    '''
+    Records wall time, memory and row counts of a block of code in STEP_METRICS.
+    Set `rows_out` on the yielded record to record the output rows, and the dropped rows of filter steps.
+    '''
+    record = {'step': step, 'rows_in': rows_in, 'rows_out': None}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        record['rss_mb'] = round(current_rss() / 1024 ** 2, 1)
+        record['peak_rss_mb'] = round(peak_rss() / 1024 ** 2, 1)
+        if filter_step and record['rows_in'] is not None and record['rows_out'] is not None:
+            record['rows_dropped'] = record['rows_in'] - record['rows_out']
+        STEP_METRICS.append(record)
+        logging.getLogger(__name__).debug(f"Step metrics: {record}")
+
+
+def instrument(func=None, filter_step=False):
+    '''
+    Decorator recording the metrics of a pipeline step (see `track_step`). The row counts are taken
+    from the first DataFrame argument and from the result, if it is a DataFrame.
+    Use `@instrument(filter_step=True)` for steps that drop rows.
+    '''
+    if func is None:
+        return functools.partial(instrument, filter_step=filter_step)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        import pandas as pd
+        frames = [arg for arg in args if isinstance(arg, pd.DataFrame)]
+        with track_step(func.__name__, len(frames[0]) if frames else None, filter_step) as record:
+            result = func(*args, **kwargs)
+            if isinstance(result, pd.DataFrame):
+                record['rows_out'] = len(result)
+        return result
+    return wrapper
+
+
+def write_metrics(path):
+    '''
+    Writes the recorded step metrics as JSON or csv (based on the file extension).
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if os.path.splitext(path)[1] == '.csv':
+        import pandas as pd
+        pd.DataFrame(STEP_METRICS).to_csv(path, index=False)
+    else:
+        with open(path, 'w') as f:
+            json.dump(STEP_METRICS, f, indent=2)
+    logging.getLogger(__name__).info(f"Step metrics saved to {path}.")
+
+
+def data_path(path, storage_format='csv'):
+    '''
+    Returns the data path with the file extension of the given storage format.
+    '''
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError(f"Unknown storage format '{storage_format}', use one of {list(STORAGE_FORMATS)}")
+    return os.path.splitext(path)[0] + STORAGE_FORMATS[storage_format]
+
+
+def apply_dtypes(df):
+    '''
+    Casts the known transparency report columns to their dtypes in the schema (see schema.py),
+    with sorted categories and without unused ones. Every reader and writer passes the data through it.
+    '''
+    return apply_schema(df)
+
+
+def read_data(path, columns=None):
+    '''
+    Reads a dataset stored as csv, parquet or feather (based on the file extension).
+    Only the given columns are read if `columns` is set.
+    '''
+    import pandas as pd
+    extension = os.path.splitext(path)[1]
+    if extension == '.parquet':
+        df = pd.read_parquet(path, columns=columns)
+    elif extension == '.feather':
+        df = pd.read_feather(path, columns=columns)
+    else:
+        dtypes = schema_dtypes(columns)
+        df = pd.read_csv(path, usecols=columns, dtype=dtypes)
+    return apply_dtypes(df)
+
+
+def write_data(df, path):
+    '''
+    Writes a dataset with explicit dtypes as csv, parquet or feather (based on the file extension).
+    Parquet files are zstd compressed, feather files lz4 compressed.
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    df = apply_dtypes(df)
+    extension = os.path.splitext(path)[1]
+    if extension == '.parquet':
+        df.to_parquet(path, index=False, compression='zstd')
+    elif extension == '.feather':
+        df.reset_index(drop=True).to_feather(path, compression='lz4')
+    else:
+        df.to_csv(path, index=False)
+
+
+def iter_data(path, columns=None, chunk_rows=1000000):
+    '''
+    Reads a dataset stored as csv, parquet or feather in chunks of at most `chunk_rows` rows,
+    so that only one chunk (and only the given columns) is held in memory at a time.
+    '''
+    extension = os.path.splitext(path)[1]
+    if extension not in ('.parquet', '.feather'):
+        import pandas as pd
+        dtypes = schema_dtypes(columns)
+        for chunk in pd.read_csv(path, usecols=columns, dtype=dtypes, chunksize=chunk_rows):
+            yield apply_dtypes(chunk)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    if extension == '.parquet':
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns)
+    else:
+        reader = pa.ipc.open_file(path)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    # Feather files are written in small record batches, which are combined into chunks
+    pending, pending_rows = [], 0
+    for batch in batches:
+        if columns is not None:
+            batch = batch.select(columns)
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        if pending_rows >= chunk_rows:
+            yield apply_dtypes(pa.Table.from_batches(pending).to_pandas())
+            pending, pending_rows = [], 0
+    if pending:
+        yield apply_dtypes(pa.Table.from_batches(pending).to_pandas())
+
+
+def write_data_chunks(chunks, path):
+    '''
+    Writes DataFrame chunks one after another into one csv, parquet or feather file (based on the
+    file extension), so the combined data never has to fit into memory.
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    extension = os.path.splitext(path)[1]
+    if extension not in ('.parquet', '.feather'):
+        with open(path, 'w', newline='') as f:
+            for i, chunk in enumerate(chunks):
+                apply_dtypes(chunk).to_csv(f, header=(i == 0), index=False)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    writer = None
+    for chunk in chunks:
+        table = pa.Table.from_pandas(apply_dtypes(chunk), preserve_index=False)
+        if writer is None:
+            schema = table.schema
+            if extension == '.parquet':
+                # pandas picks the dictionary index width per chunk (int8 below 128 categories), so all chunks
+                # are written with int32 indices, wide enough for the categories of any later chunk
+                schema = pa.schema([
+                    field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+                    if pa.types.is_dictionary(field.type) else field
+                    for field in schema
+                ], metadata=schema.metadata)
+                writer = pq.ParquetWriter(path, schema, compression='zstd')
+            else:
+                # The Arrow IPC file format cannot hold different dictionaries per batch, so categories are decoded
+                schema = pa.schema([
+                    field.with_type(field.type.value_type) if pa.types.is_dictionary(field.type) else field
+                    for field in schema
+                ], metadata=schema.metadata)
+                writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression='lz4'))
+        writer.write_table(table.cast(schema))
+    if writer is None:
+        raise ValueError(f"No data chunks to write to {path}")
+    writer.close()
+
+
+def concat_data_files(paths, path):
+    '''
+    Concatenates datasets written by `write_data` into one file, one input file at a time,
+    so the combined data never has to fit into memory.
+    '''
+    if os.path.splitext(path)[1] == '.csv':
+        with open(path, 'wb') as out:
+            for i, part_path in enumerate(paths):
+                with open(part_path, 'rb') as part:
+                    if i > 0:
+                        part.readline()  # Skip the repeated header
+                    shutil.copyfileobj(part, out)
+    else:
+        write_data_chunks((read_data(part_path) for part_path in paths), path)
+
+
+def write_mapped_data(df, path):
+    '''
+    Writes a dataset as an uncompressed Arrow IPC file, which other processes can memory-map instead
+    of loading it. The file is written under a temporary name and then renamed, so readers never
+    see a partially written file.
+    '''
+    import pyarrow as pa
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    table = pa.Table.from_pandas(apply_dtypes(df), preserve_index=False)
+    temp_path = f"{path}.incomplete"
+    with pa.OSFile(temp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+
+def read_mapped_data(path, columns=None, filters=None):
+    '''
+    Memory-maps an Arrow IPC file written by `write_mapped_data`. The file stays in the page cache
+    shared by all processes. Only the given columns of the rows matching `filters` ({column: list of
+    allowed values}) are read. Without filters, float64 columns without missing values stay read-only
+    views of the mapped file. The nullable integer and categorical columns are converted into a copy,
+    and so are all columns of filtered rows.
+    '''
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+    for column, values in (filters or {}).items():
+        value_type = table[column].type
+        if pa.types.is_dictionary(value_type):
+            value_type = value_type.value_type
+        table = table.filter(pc.is_in(table[column], value_set=pa.array(values, type=value_type)))
+    if columns is not None:
+        table = table.select(columns)
+    return apply_dtypes(table.to_pandas(split_blocks=True))
+
+
+def replace_values(series, mapping):
+    '''
+    Replaces values according to `mapping`. Categorical series are remapped on their
+    categories only, so the work does not grow with the number of rows. The new categories
+    are sorted, but unused categories are kept: `apply_dtypes` drops them when the data is
+    written, read or handed over to the analysis.
+    '''
+    import numpy as np
+    import pandas as pd
+    if not isinstance(series.dtype, pd.CategoricalDtype):
+        return series.replace(mapping)
+    categories = series.cat.categories
+    renamed = pd.Index([mapping.get(category, category) for category in categories])
+    new_categories = renamed.unique().sort_values()
+    category_codes = new_categories.get_indexer(renamed)
+    codes = series.cat.codes.to_numpy()
+    new_codes = np.where(codes >= 0, category_codes[codes], -1)
+    return pd.Series(
+        pd.Categorical.from_codes(new_codes, categories=new_categories),
+        index=series.index, name=series.name
+    )
+
+
+def fill_missing(series, value):
+    '''
+    Fills missing values, adding `value` as a category first for categorical series.
+    '''
+    import pandas as pd
+    if isinstance(series.dtype, pd.CategoricalDtype) and value not in series.cat.categories:
+        series = series.cat.add_categories([value])
+    return series.fillna(value)
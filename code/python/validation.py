@@ -0,0 +1,187 @@
+# --- Header -------------------------------------------------------------------
+# Declarative data quality rules for the pulled transparency report data, checked in one pass
+# with boolean masks, and the per-rule violation report
+#
+# See LICENSE file for details
+# ------------------------------------------------------------------------------
+import os
+import json
+
+import numpy as np
+from utils import setup_logging
+
+log = setup_logging()
+
+# Rows with a blank value in one of these fields are dropped
+VITAL_FIELDS = ['transparency_report_fkey', 'entity_map_fkey', 'auditor_fkey', 'trans_report_auditor_state']
+
+# Entities listed by several audit firms within a report year are joint audits
+JOINT_AUDIT_KEYS = ['entity_map_fkey', 'report_year']
+
+# Keys identifying the violating rows in the report, and the number of them kept per rule
+SAMPLE_KEYS = ['transparency_report_fkey', 'entity_map_fkey']
+SAMPLE_SIZE = 5
+
+# Violations recorded by `check_rules` in this process
+VALIDATION_RESULTS = []
+
+def blank(column):
+    '''
+    Check: the value of `column` is missing.
+    '''
+    return lambda df, keep, taxonomy: df[column].isna().to_numpy()
+
+def disclosed_pies_not_positive(df, keep, taxonomy):
+    '''
+    Check: the report discloses no PIEs (number_of_disclosed_pies is missing, zero or negative).
+    '''
+    return ~(df['number_of_disclosed_pies'] > 0).fillna(False).to_numpy(dtype=bool)
+
+def listed_entities(df):
+    '''
+    Number of unique entities listed in the transparency report of every row.
+    '''
+    return df.groupby('transparency_report_fkey')['entity_map_fkey'].transform('nunique')
+
+def more_entities_than_disclosed_pies(df, keep, taxonomy):
+    '''
+    Check: the report lists more entities than it discloses PIEs (possibly non-PIE entities).
+    '''
+    return (listed_entities(df) > df['number_of_disclosed_pies']).fillna(False).to_numpy(dtype=bool)
+
+def fewer_entities_than_disclosed_pies(df, keep, taxonomy):
+    '''
+    Check: the report lists fewer entities than it discloses PIEs (possibly missing PIE entities).
+    '''
+    return (listed_entities(df) < df['number_of_disclosed_pies']).fillna(False).to_numpy(dtype=bool)
+
+def joint_audit(df, keep, taxonomy):
+    '''
+    Check: the entity is listed by several audit firms in the report year, among the kept rows.
+    '''
+    entities = df['entity_map_fkey'].where(keep)
+    joint_auditors = df['auditor_fkey'].groupby([entities, df['report_year']], dropna=False).transform('nunique')
+    return keep & (joint_auditors > 1).to_numpy()
+
+def known_networks(taxonomy):
+    '''
+    Network names of the taxonomy: the networks of the groups, the aliases and their standardized names,
+    and the known networks of the default group (optional `unaffiliated` list).
+    '''
+    known = {network for group in taxonomy['groups'] for network in group['networks']}
+    known |= set(taxonomy['aliases']) | set(taxonomy['aliases'].values())
+    return known | set(taxonomy.get('unaffiliated') or [])
+
+def unknown_network(df, keep, taxonomy):
+    '''
+    Check: the auditor network of a kept row is not a known network of the network taxonomy,
+    so it falls into the default group unnoticed.
+    '''
+    known = known_networks(taxonomy)
+    networks = df['auditor_network']
+    return keep & (networks.notna() & ~networks.isin(known)).to_numpy()
+
+# The rules: 'drop' rules remove the violating rows, 'flag' rules only report them. Row rules only look at
+# the row itself, so they can be checked chunk by chunk. Report rules compare rows across transparency
+# reports and need all rows (or at least the columns they use).
+RULES = [
+    *[
+        {'name': f'blank_{field}', 'action': 'drop', 'scope': 'row', 'columns': [field], 'check': blank(field),
+         'description': f"Blank {field}, a vital field"}
+        for field in VITAL_FIELDS
+    ],
+    {'name': 'disclosed_pies_not_positive', 'action': 'drop', 'scope': 'row',
+     'columns': ['number_of_disclosed_pies'], 'check': disclosed_pies_not_positive,
+     'description': "The report discloses no PIEs (number_of_disclosed_pies <= 0 or blank)"},
+    {'name': 'unknown_network', 'action': 'flag', 'scope': 'row',
+     'columns': ['auditor_network'], 'check': unknown_network,
+     'description': "The auditor network is not a known network of the network taxonomy and is grouped as the default group"},
+    {'name': 'more_entities_than_disclosed_pies', 'action': 'flag', 'scope': 'report',
+     'columns': ['transparency_report_fkey', 'entity_map_fkey', 'number_of_disclosed_pies'],
+     'check': more_entities_than_disclosed_pies,
+     'description': "The report lists more entities than disclosed PIEs (possibly non-PIE entities)"},
+    {'name': 'fewer_entities_than_disclosed_pies', 'action': 'flag', 'scope': 'report',
+     'columns': ['transparency_report_fkey', 'entity_map_fkey', 'number_of_disclosed_pies'],
+     'check': fewer_entities_than_disclosed_pies,
+     'description': "The report lists fewer entities than disclosed PIEs (possibly missing PIE entities)"},
+    {'name': 'joint_audit', 'action': 'flag', 'scope': 'report',
+     'columns': JOINT_AUDIT_KEYS + ['auditor_fkey'], 'check': joint_audit,
+     'description': "The entity is listed by several audit firms in the report year (joint audit)"},
+]
+
+def rule_columns(scope):
+    '''
+    Returns the columns the rules of a scope need, plus the sample keys.
+    '''
+    columns = SAMPLE_KEYS + [column for rule in RULES if rule['scope'] == scope for column in rule['columns']]
+    return list(dict.fromkeys(columns))
+
+def check_rules(df, taxonomy, scope=None, keep=None):
+    '''
+    Checks all rules (or the rules of one scope) on a DataFrame and records the number of violations
+    and a few sample keys per rule in VALIDATION_RESULTS. Every rule yields one boolean mask over the rows,
+    no rows are copied. The 'drop' rules are checked in the order of RULES against the rows still kept,
+    so a row is only counted by the first rule dropping it, and the 'flag' rules against the kept rows.
+    Returns the mask of the rows violating no 'drop' rule (`keep` if given, in which case only the
+    'flag' rules are checked).
+    '''
+    rules = [rule for rule in RULES if scope is None or rule['scope'] == scope]
+    if keep is None:
+        keep = np.ones(len(df), dtype=bool)
+        for rule in rules:
+            if rule['action'] == 'drop':
+                violations = rule['check'](df, keep, taxonomy) & keep
+                record_violations(df, rule, violations, keep)
+                keep &= ~violations
+    for rule in rules:
+        if rule['action'] == 'flag':
+            record_violations(df, rule, rule['check'](df, keep, taxonomy) & keep, keep)
+    return keep
+
+def record_violations(df, rule, violations, checked):
+    '''
+    Records the number of rows checked (the `checked` mask) and violating a rule, with the keys of
+    the first violating rows.
+    '''
+    samples = df[[key for key in SAMPLE_KEYS if key in df.columns]].iloc[np.flatnonzero(violations)[:SAMPLE_SIZE]]
+    VALIDATION_RESULTS.append({
+        'rule': rule['name'],
+        'rows_checked': int(checked.sum()),
+        'violations': int(violations.sum()),
+        'sample_keys': json.loads(samples.to_json(orient='records')),
+    })
+
+def validation_report():
+    '''
+    Combines the recorded violations (e.g. of several chunks) into one entry per rule, in the order of RULES.
+    '''
+    report = []
+    for rule in RULES:
+        results = [result for result in VALIDATION_RESULTS if result['rule'] == rule['name']]
+        if not results:
+            continue
+        report.append({
+            'rule': rule['name'],
+            'action': rule['action'],
+            'description': rule['description'],
+            'rows_checked': sum(result['rows_checked'] for result in results),
+            'violations': sum(result['violations'] for result in results),
+            'sample_keys': [key for result in results for key in result['sample_keys']][:SAMPLE_SIZE],
+        })
+    return report
+
+def write_validation_report(path):
+    '''
+    Logs one line per violated rule and writes the validation report as JSON.
+    '''
+    report = validation_report()
+    for entry in report:
+        if entry['violations'] > 0:
+            consequence = 'dropped' if entry['action'] == 'drop' else 'flagged'
+            log.warning(f"Validation rule '{entry['rule']}': {entry['violations']} rows {consequence}. {entry['description']}.")
+    if all(entry['violations'] == 0 for entry in report):
+        log.info("All validation rules passed.")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    log.info(f"Validation report saved to {path}.")
@@ -0,0 +1,55 @@
+import os
+import pytest
+
+import utils
+import validation
+from utils import read_config, data_path, write_data
+from synthetic_data import generate_transparency_reports
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def local_paths(cfg, root):
+    '''
+    Returns a copy of a config with every path (keys ending in _path or _dir) moved under `root`.
+    '''
+    moved = {}
+    for key, value in cfg.items():
+        if isinstance(value, dict):
+            moved[key] = local_paths(value, root)
+        elif isinstance(value, str) and key.endswith(('_path', '_dir')):
+            moved[key] = os.path.join(root, value)
+        else:
+            moved[key] = value
+    return moved
+
+def read_stage_config(name, root):
+    return local_paths(read_config(os.path.join(REPO_ROOT, 'config', name)), root)
+
+@pytest.fixture(autouse=True)
+def clear_recorded_results():
+    '''
+    Every test starts without the step metrics and validation results recorded by earlier tests.
+    '''
+    utils.STEP_METRICS.clear()
+    validation.VALIDATION_RESULTS.clear()
+
+@pytest.fixture(scope='session')
+def pulled_data():
+    '''
+    Synthetic pulled data with joint audits, blank networks and blank vital fields.
+    '''
+    return generate_transparency_reports(5000, seed=1)
+
+@pytest.fixture
+def stage_configs(tmp_path, pulled_data):
+    '''
+    Returns a function creating the prepare and analysis configs of a run in its own directory, with the
+    synthetic pulled data saved in the storage format of the run. Keyword arguments override settings of both.
+    '''
+    def make(run='run', **settings):
+        root = str(tmp_path / run)
+        prepare_cfg = {**read_stage_config('prepare_data_cfg.yaml', root), **settings}
+        analysis_cfg = {**read_stage_config('do_analysis_cfg.yaml', root), **settings}
+        write_data(pulled_data, data_path(prepare_cfg['audit_analytics_save_path'], prepare_cfg['storage_format']))
+        return prepare_cfg, analysis_cfg
+    return make
@@ -0,0 +1,9 @@
+import numpy as np
+
+from benchmark import time_step
+
+def test_time_step_measures_the_peak_memory_of_the_step():
+    # The step allocates and frees an 8 MB array, only the peak stays visible
+    seconds, peak_memory = time_step(lambda n: float(np.ones(n).sum()), lambda: (1_000_000,), repeats=2)
+    assert seconds > 0
+    assert 8_000_000 <= peak_memory < 9_000_000
@@ -0,0 +1,25 @@
+import pandas as pd
+
+from prepare_data import prepare
+from do_analysis import analyse
+
+def bootstrap_intervals(analysis_cfg, **settings):
+    '''
+    Bootstraps the market shares with a small number of replicates and the given bootstrap settings.
+    '''
+    bootstrap_cfg = {
+        **analysis_cfg['bootstrap'], 'enabled': True, 'replicates': 200, 'batch_size': 50, 'workers': 1, 'seed': 7,
+        **settings
+    }
+    return analyse({**analysis_cfg, 'bootstrap': bootstrap_cfg})['bootstrap']
+
+def test_bootstrap_is_deterministic_for_a_fixed_seed(stage_configs):
+    prepare_cfg, analysis_cfg = stage_configs()
+    prepare(prepare_cfg)
+    intervals = bootstrap_intervals(analysis_cfg)
+    assert intervals.filter(like='_ci_').notna().all().all()
+
+    pd.testing.assert_frame_equal(bootstrap_intervals(analysis_cfg), intervals)
+    # Every batch has its own seed, so the intervals do not depend on the number of workers
+    pd.testing.assert_frame_equal(bootstrap_intervals(analysis_cfg, workers=2), intervals)
+    assert not bootstrap_intervals(analysis_cfg, seed=8).equals(intervals)
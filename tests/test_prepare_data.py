@@ -0,0 +1,78 @@
+import os
+import pandas as pd
+
+from utils import apply_dtypes, data_path, read_data, write_data
+from prepare_data import prepare, count_joint_auditors, assign_joint_audit_weights
+
+def transparency_rows(rows):
+    '''
+    Builds prepared-like data from (transparency_report_fkey, entity_map_fkey, auditor_fkey) tuples of 2021.
+    '''
+    df = pd.DataFrame(rows, columns=['transparency_report_fkey', 'entity_map_fkey', 'auditor_fkey'])
+    return apply_dtypes(df.assign(report_year=2021))
+
+def test_duplicated_entity_of_one_firm_is_not_a_joint_audit():
+    # Entity 10 is listed twice by firm 100, entity 20 by firms 100 and 200
+    df = transparency_rows([(1, 10, 100), (1, 10, 100), (1, 20, 100), (2, 20, 200)])
+    assert count_joint_auditors(df).tolist() == [1, 1, 2, 2]
+
+def test_joint_audit_weights_of_the_rules():
+    rows = [(1, 10, 100), (1, 10, 100), (1, 20, 100), (2, 20, 200)]
+    weights = {rule: assign_joint_audit_weights(transparency_rows(rows), rule)['audit_weight'].tolist()
+               for rule in ['full', 'split', 'exclude']}
+    assert weights == {
+        'full': [1.0, 1.0, 1.0, 1.0],
+        'split': [1.0, 1.0, 0.5, 0.5],
+        'exclude': [1.0, 1.0, 0.0, 0.0],
+    }
+
+def read_sorted(path):
+    '''
+    Reads a dataset in a fixed row order, to compare datasets whose rows were appended in another order.
+    '''
+    df = read_data(path)
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+def prepared_path(cfg):
+    return data_path(cfg['prepared_data_save_path'], cfg['storage_format'])
+
+def test_chunked_preparation_equals_eager(stage_configs):
+    eager_cfg, _ = stage_configs('eager')
+    chunked_cfg, _ = stage_configs('chunked', backend='chunked', chunk_rows=700)
+    prepare(eager_cfg)
+    prepare(chunked_cfg)
+    with open(prepared_path(eager_cfg), 'rb') as eager, open(prepared_path(chunked_cfg), 'rb') as chunked:
+        assert eager.read() == chunked.read()
+
+def test_incremental_preparation_equals_full(stage_configs, pulled_data):
+    full_cfg, _ = stage_configs('full', joint_audits='split')
+    incremental_cfg, _ = stage_configs('incremental', joint_audits='split', incremental=True)
+    pulled_path = data_path(incremental_cfg['audit_analytics_save_path'], incremental_cfg['storage_format'])
+
+    # The previous pull misses reports 1 to 3, has another number of PIEs for report 4 and a report removed since
+    reports = pulled_data['transparency_report_fkey']
+    previous = pulled_data[~reports.isin([1, 2, 3])].copy()
+    previous.loc[previous['transparency_report_fkey'] == 4, 'number_of_disclosed_pies'] += 1
+    removed = pulled_data[reports == 5].assign(transparency_report_fkey=99999)
+    write_data(pd.concat([previous, removed], ignore_index=True), pulled_path)
+    prepare(incremental_cfg)
+
+    write_data(pulled_data, pulled_path)
+    prepare(incremental_cfg)
+    prepare(full_cfg)
+    pd.testing.assert_frame_equal(read_sorted(prepared_path(incremental_cfg)), read_sorted(prepared_path(full_cfg)))
+
+def test_stage_cache_hit_restores_identical_outputs(stage_configs):
+    prepare_cfg, _ = stage_configs()
+    outputs = [prepared_path(prepare_cfg), prepare_cfg['validation_report_save_path']]
+    assert prepare(prepare_cfg) is not None
+    prepared = {}
+    for path in outputs:
+        with open(path, 'rb') as f:
+            prepared[path] = f.read()
+        os.remove(path)
+
+    assert prepare(prepare_cfg) is None  # Restored from the stage cache
+    for path in outputs:
+        with open(path, 'rb') as f:
+            assert f.read() == prepared[path]
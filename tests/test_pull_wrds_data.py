@@ -0,0 +1,49 @@
+import sqlite3
+import pandas as pd
+import pytest
+
+from utils import apply_dtypes, data_path, read_data
+from synthetic_data import generate_transparency_reports
+from pull_wrds_data import pull, pull_wrds_data, plan_partitions
+from conftest import read_stage_config
+
+@pytest.fixture
+def pull_config(tmp_path):
+    '''
+    Returns a function creating the pull config of a run, pulling from a SQLite stand-in for WRDS
+    with the synthetic data of two report years. Some rows have no transparency_report_fkey.
+    '''
+    database_path = str(tmp_path / 'wrds_standin.db')
+    reports = generate_transparency_reports(3000, report_years=(2020, 2021), seed=2)
+    reports.loc[::250, 'transparency_report_fkey'] = None
+    with sqlite3.connect(database_path) as db:
+        reports.rename(columns=str.upper).astype({'TRANS_REPORT_AUDITOR_STATE': object, 'AUDITOR_NETWORK': object}) \
+            .to_sql('feed76_transparency_reports', db, index=False)
+
+    def make(run='run', **settings):
+        cfg = read_stage_config('pull_data_cfg.yaml', str(tmp_path / run))
+        return {**cfg, 'local_database': database_path, 'report_years': [2020, 2021], **settings}
+    return make
+
+def sort_rows(df):
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+def read_pulled(cfg):
+    return sort_rows(read_data(data_path(cfg['audit_analytics_save_path'], cfg['storage_format'])))
+
+def test_parallel_pull_equals_single_pull(pull_config):
+    parallel_cfg = pull_config('parallel', country_shards=3, max_connections=2)
+    assert len(plan_partitions(parallel_cfg)) == 6
+    pull(parallel_cfg)
+
+    single = apply_dtypes(pull_wrds_data(pull_config('single'), None))
+    assert len(single) > 0
+    pd.testing.assert_frame_equal(read_pulled(parallel_cfg), sort_rows(single))
+
+def test_chunked_pull_equals_single_pull(pull_config):
+    chunked_cfg = pull_config('chunked', pull_mode='chunked', chunk_size=7)
+    pull(chunked_cfg)
+
+    single = apply_dtypes(pull_wrds_data(pull_config('single'), None))
+    assert single['transparency_report_fkey'].isna().any()
+    pd.testing.assert_frame_equal(read_pulled(chunked_cfg), sort_rows(single))
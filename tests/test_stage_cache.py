@@ -0,0 +1,25 @@
+import os
+import json
+import yaml
+
+import utils
+import prepare_data
+import do_analysis
+
+def test_cache_hits_are_recorded_in_the_metrics_of_both_stages(stage_configs, tmp_path, monkeypatch):
+    prepare_cfg, analysis_cfg = stage_configs()
+    os.makedirs(tmp_path / 'config')
+    for name, cfg in [('prepare_data_cfg.yaml', prepare_cfg), ('do_analysis_cfg.yaml', analysis_cfg)]:
+        with open(tmp_path / 'config' / name, 'w') as f:
+            yaml.safe_dump(cfg, f)
+    monkeypatch.chdir(tmp_path)
+
+    for stage, cfg in [(prepare_data, prepare_cfg), (do_analysis, analysis_cfg)]:
+        for cached in [False, True]:
+            utils.STEP_METRICS.clear()
+            stage.main()
+            with open(cfg['metrics_save_path']) as f:
+                metrics = json.load(f)
+            assert [record['cached'] for record in metrics if record['step'] == 'stage_cache'] == [cached]
+            if cached:
+                assert len(metrics) == 1
@@ -0,0 +1,42 @@
+import pytest
+import pandas as pd
+
+from utils import data_path, read_data
+from prepare_data import prepare
+from do_analysis import analyse, save_results
+
+RUNS = {
+    'csv': {'storage_format': 'csv'},
+    'parquet': {'storage_format': 'parquet'},
+    'feather': {'storage_format': 'feather'},
+    'csv_chunked': {'storage_format': 'csv', 'backend': 'chunked', 'chunk_rows': 700},
+    'parquet_chunked': {'storage_format': 'parquet', 'backend': 'chunked', 'chunk_rows': 700},
+}
+
+def run_stages(stage_configs, run):
+    '''
+    Prepares and analyses the synthetic data with the settings of a run, returns the analysis config.
+    '''
+    prepare_cfg, analysis_cfg = stage_configs(run, **RUNS[run])
+    prepare(prepare_cfg)
+    save_results(analysis_cfg, analyse(analysis_cfg))
+    return analysis_cfg
+
+@pytest.mark.parametrize('output', ['aggregated_data_save_path', 'auditor_ranking_save_path'])
+def test_outputs_are_byte_identical_across_formats_and_backends(stage_configs, output):
+    outputs = {}
+    for run in RUNS:
+        with open(run_stages(stage_configs, run)[output], 'rb') as f:
+            outputs[run] = f.read()
+    assert all(content == outputs['csv'] for content in outputs.values())
+
+def test_in_memory_data_is_analysed_in_the_order_read_from_disk(stage_configs):
+    analysis_cfg = run_stages(stage_configs, 'csv')
+    prepared_data = read_data(data_path(analysis_cfg['prepared_data_save_path'], 'csv'))
+    # Categories in reverse order plus an unused one, as left by steps adding categories
+    for column in ['trans_report_auditor_state', 'network_group']:
+        categories = list(prepared_data[column].cat.categories[::-1]) + ['unused']
+        prepared_data[column] = prepared_data[column].cat.set_categories(categories)
+    results = analyse(analysis_cfg, prepared_data)
+    for name, df in analyse(analysis_cfg).items():
+        pd.testing.assert_frame_equal(results[name], df)
@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+from utils import read_data, iter_data, write_data, write_mapped_data, read_mapped_data
+
+@pytest.fixture
+def unsorted_categories():
+    '''
+    Data with categories in reverse order and an unused category, as left by steps adding categories.
+    '''
+    return pd.DataFrame({
+        'transparency_report_fkey': pd.array([1, 2, 3], dtype='Int32'),
+        'trans_report_auditor_state': pd.Categorical(['DE', 'AT', 'DE'], categories=['FR', 'DE', 'AT']),
+    })
+
+@pytest.mark.parametrize('extension', ['.csv', '.parquet', '.feather'])
+def test_readers_sort_the_categories(tmp_path, unsorted_categories, extension):
+    path = str(tmp_path / f'data{extension}')
+    write_data(unsorted_categories, path)
+    for df in [read_data(path), next(iter_data(path, chunk_rows=2))]:
+        assert df['trans_report_auditor_state'].cat.categories.tolist() == ['AT', 'DE']
+    assert read_data(path)['trans_report_auditor_state'].tolist() == ['DE', 'AT', 'DE']
+
+def test_mapped_data_has_sorted_categories(tmp_path, unsorted_categories):
+    path = str(tmp_path / 'data.arrow')
+    write_mapped_data(unsorted_categories, path)
+    df = read_mapped_data(path)
+    assert df['trans_report_auditor_state'].cat.categories.tolist() == ['AT', 'DE']
+    assert df['trans_report_auditor_state'].tolist() == ['DE', 'AT', 'DE']
+
+def test_mapped_float_columns_are_views_of_the_file(tmp_path, unsorted_categories):
+    path = str(tmp_path / 'data.arrow')
+    write_mapped_data(unsorted_categories.assign(audit_weight=[1.0, 0.5, 0.5]), path)
+    assert not read_mapped_data(path)['audit_weight'].to_numpy().flags.writeable
+    # Filtered rows are copied
+    filtered = read_mapped_data(path, filters={'trans_report_auditor_state': ['DE']})
+    assert filtered['audit_weight'].tolist() == [1.0, 0.5]
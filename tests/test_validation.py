@@ -0,0 +1,50 @@
+import json
+import numpy as np
+import pandas as pd
+
+import validation
+from utils import apply_dtypes, read_config
+from prepare_data import prepare
+from validation import check_rules, validation_report
+from conftest import REPO_ROOT
+
+TAXONOMY = read_config(f'{REPO_ROOT}/config/prepare_data_cfg.yaml')['network_taxonomy']
+
+def report_by_rule():
+    return {entry['rule']: entry for entry in validation_report()}
+
+def test_rows_are_counted_by_the_first_drop_rule_only():
+    df = apply_dtypes(pd.DataFrame({
+        'transparency_report_fkey': [1, 1, 1],
+        'entity_map_fkey': [10, None, None],
+        'auditor_fkey': [100, None, 100],
+        'trans_report_auditor_state': ['DE', 'DE', 'DE'],
+        'auditor_network': ['|KPMG International|'] * 3,
+        'report_year': [2021] * 3,
+        'number_of_disclosed_pies': [0, 3, 3],
+    }))
+    keep = check_rules(df, TAXONOMY, scope='row')
+    assert keep.tolist() == [False, False, False]
+    report = report_by_rule()
+    assert report['blank_entity_map_fkey']['violations'] == 2
+    assert report['blank_auditor_fkey']['violations'] == 0
+    assert report['blank_auditor_fkey']['rows_checked'] == 1
+    assert report['disclosed_pies_not_positive']['violations'] == 1
+
+def test_known_networks_are_not_flagged():
+    networks = [
+        '|KPMG International|', '|Morison KSi|', '|Morison International|', '|Crowe Global|', '|Unknown Network|', None
+    ]
+    df = apply_dtypes(pd.DataFrame({'auditor_network': networks}))
+    flagged = validation.unknown_network(df, np.ones(len(df), dtype=bool), TAXONOMY)
+    assert flagged.tolist() == [False, False, False, False, True, False]
+
+def test_chunked_validation_report_equals_eager(stage_configs):
+    reports = {}
+    for run, settings in {'eager': {}, 'chunked': {'backend': 'chunked', 'chunk_rows': 700}}.items():
+        validation.VALIDATION_RESULTS.clear()
+        prepare_cfg, _ = stage_configs(run, **settings)
+        prepare(prepare_cfg)
+        with open(prepare_cfg['validation_report_save_path']) as f:
+            reports[run] = json.load(f)
+    assert reports['chunked'] == reports['eager']